@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+import argparse
+import BaseHTTPServer
+import json
+import SocketServer
+import subprocess
+import threading
+import time
+
+import md_testsuite
+
+parser = argparse.ArgumentParser(
+    description="Local stand-in for REST markdown APIs such as the GitHub one used by the `gfm` engine.",
+    epilog=r"""Serves `POST /markdown` with a JSON body of the form `{{"text": "..."}}`,
+and responds with the output of `command` given `text` on stdin.
+
+Connections are kept alive, and `X-RateLimit-*` headers are sent
+so that rate limiting of engines can be tested.
+
+To run the `gfm` engine against markdown2, set `gfm_url = 'http://localhost:8000/markdown'` in `{config_file}`, and:
+
+    {f} markdown2 &
+    ./run-tests.py gfm
+""".format(f="./http-engine-server.py", config_file=md_testsuite.config_file),
+    formatter_class=argparse.RawTextHelpFormatter, # Keep newlines.
+)
+parser.add_argument(
+    "-p",
+    "--port",
+    default=8000,
+    type=int,
+    help="Port to listen on."
+)
+parser.add_argument(
+    "-r",
+    "--rate-limit",
+    default=0,
+    type=int,
+    help="Maximum number of requests per rate limit window. `0` for no limit."
+)
+parser.add_argument(
+    "-w",
+    "--window",
+    default=60,
+    type=int,
+    help="Duration of the rate limit window in seconds."
+)
+parser.add_argument(
+    "command",
+    nargs="+",
+    help="Command that converts markdown on stdin to HTML on stdout."
+)
+args = parser.parse_args()
+
+lock = threading.Lock()
+window = {'reset': int(time.time()) + args.window, 'used': 0}
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader('Content-Length', 0)))
+        with lock:
+            now = time.time()
+            if now >= window['reset']:
+                window['reset'] = int(now) + args.window
+                window['used'] = 0
+            window['used'] += 1
+            remaining = args.rate_limit - window['used']
+            reset = window['reset']
+        if args.rate_limit and remaining < 0:
+            self.respond(403, 'API rate limit exceeded', max(remaining, 0), reset)
+            return
+        process = subprocess.Popen(args.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        stdout, stderr = process.communicate(json.loads(body)['text'].encode(md_testsuite.encoding))
+        if process.wait() == 0:
+            self.respond(200, stdout, max(remaining, 0), reset)
+        else:
+            self.respond(500, 'Command exit status was not 0.', max(remaining, 0), reset)
+    def respond(self, status, body, remaining, reset):
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        if args.rate_limit:
+            self.send_header('X-RateLimit-Limit', str(args.rate_limit))
+            self.send_header('X-RateLimit-Remaining', str(remaining))
+            self.send_header('X-RateLimit-Reset', str(reset))
+        self.end_headers()
+        self.wfile.write(body)
+    def log_message(self, format, *args):
+        pass
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+Server(('localhost', args.port), Handler).serve_forever()
@@ -0,0 +1,133 @@
+"""
+Generators of large markdown inputs and their expected outputs, to test how engines scale.
+
+Each generator takes a size `n` and returns a `Document`.
+Documents are built from small templates which produce the input and the expected output together,
+and can be concatenated with `+` into larger documents.
+
+Expected outputs follow the Original markdown, and are meant to be compared after normalization.
+"""
+
+class Document(object):
+    """
+    Markdown input and its expected HTML output.
+
+        >>> d = paragraph(u"a") + paragraph(u"b")
+        >>> d.markdown
+        u'a\\n\\nb\\n'
+        >>> d.html
+        u'<p>a</p>\\n<p>b</p>\\n'
+    """
+    def __init__(self, markdown, html):
+        self.markdown = markdown
+        self.html = html
+
+    def __add__(self, other):
+        return Document(self.markdown + u"\n" + other.markdown, self.html + other.html)
+
+def join(documents):
+    """
+    Concatenate many documents at once, in linear time.
+    """
+    documents = list(documents)
+    return Document(
+        u"\n".join(document.markdown for document in documents),
+        u"".join(document.html for document in documents)
+    )
+
+# Inline templates: 2-tuples `(markdown, html)`.
+
+def text(words):
+    content = u" ".join(u"word{}".format(i) for i in xrange(words))
+    return content, content
+
+def emphasis(content):
+    return u"*" + content[0] + u"*", u"<em>" + content[1] + u"</em>"
+
+def reference_link(id):
+    return u"[link {0}][{0}]".format(id), u'<a href="http://example.com/{0}">link {0}</a>'.format(id)
+
+def inline_join(inlines, separator=u" "):
+    inlines = list(inlines)
+    return separator.join(i[0] for i in inlines), separator.join(i[1] for i in inlines)
+
+# Block templates.
+
+def paragraph(inline):
+    if not isinstance(inline, tuple):
+        inline = (inline, inline)
+    return Document(inline[0] + u"\n", u"<p>" + inline[1] + u"</p>\n")
+
+def blockquote(document):
+    markdown = u"".join(u"> " + line + u"\n" if line else u">\n" for line in document.markdown.splitlines())
+    return Document(markdown, u"<blockquote>\n" + document.html + u"</blockquote>\n")
+
+# Generators.
+
+def nested_lists(n):
+    """
+    `n` levels of nested unordered lists.
+    """
+    markdown = []
+    for i in xrange(n):
+        markdown.append(u"    " * i + u"* item {}\n".format(i))
+    html = u"".join(u"<ul>\n<li>item {}\n".format(i) for i in xrange(n)) + u"</li>\n</ul>\n" * n
+    return Document(u"".join(markdown), html)
+
+def reference_links(n):
+    """
+    A paragraph with `n` reference links, followed by their `n` definitions.
+    """
+    definitions = u"".join(u"[{0}]: http://example.com/{0}\n".format(i) for i in xrange(n))
+    document = paragraph(inline_join(reference_link(i) for i in xrange(n)))
+    return Document(document.markdown + u"\n" + definitions, document.html)
+
+def long_paragraph(n):
+    """
+    A single paragraph of `n` KB of text.
+    """
+    return paragraph(text(n * 1024 // 7))
+
+def emphasis_run(n):
+    """
+    A paragraph with `n` consecutive emphasized words.
+    """
+    return paragraph(inline_join(emphasis(text(1)) for i in xrange(n)))
+
+def nested_blockquotes(n):
+    """
+    `n` levels of nested blockquotes around a paragraph.
+    """
+    document = paragraph(u"quote")
+    for i in xrange(n):
+        document = blockquote(document)
+    return document
+
+def many_paragraphs(n):
+    """
+    `n` short paragraphs.
+    """
+    return join(paragraph(text(8)) for i in xrange(n))
+
+# Generators by name, with the size of the smallest document used to measure scaling.
+generators = {
+    'emphasis-run': (emphasis_run, 1000),
+    'long-paragraph': (long_paragraph, 64),
+    'many-paragraphs': (many_paragraphs, 500),
+    'nested-blockquotes': (nested_blockquotes, 16),
+    'nested-lists': (nested_lists, 16),
+    'reference-links': (reference_links, 250),
+}
+
+def io_iterator(multipliers=(1, 2, 4, 8), names=None):
+    """
+    Iterator over generated input output pairs of increasing size, like `md_testsuite.io_iterator`.
+
+    Each yield returns a 4-tuple `(path, input, output, n)` where `path` is of the form `name-n`.
+    """
+    for name in sorted(names or generators):
+        generator, base_size = generators[name]
+        for multiplier in multipliers:
+            n = base_size * multiplier
+            document = generator(n)
+            yield (u"{}-{}".format(name, n), document.markdown, document.html, n)
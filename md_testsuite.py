@@ -2,17 +2,51 @@
 Shared functionality.
 """
 
+import collections
+import ctypes
+import ctypes.util
+import gzip
+import hashlib
+import HTMLParser
 import imp
+import json
 import os
+import re
+import select
+import sqlite3
+import struct
+import tarfile
+import threading
+import time
 
 # Default config values here.
 config_file_noext = 'config_local'
 config_file = config_file_noext + '.py'
 config = dict(
     gfm_oauth_token = '',
+    gfm_url = 'https://api.github.com/markdown',
     # GFM off by default because it is too slow.
     run_all_disable = ['gfm'],
-    timeout = 5
+    timeout = 5,
+    # Limits for each engine command on a single test: wall clock and CPU time in seconds,
+    # and data memory in bytes. `0` disables a limit.
+    test_timeout = 30,
+    test_cpu_limit = 30,
+    test_memory_limit = 2 * 2**30,
+    # Maximum number of simultaneous requests to each REST API engine.
+    http_connections = 4,
+    # Number of times a failed REST API request is retried.
+    http_retries = 3,
+    # Fail REST API requests instead of waiting longer than this many seconds for the rate limit to reset.
+    http_max_wait = 60,
+    # Directory where outputs and other reusable data are cached across runs.
+    cache_dir = '.cache',
+    # Maximum total size of the cached outputs in bytes.
+    cache_max_size = 64 * 2**20,
+    # Maximum total length of the normalized outputs kept in memory to normalize identical outputs only once.
+    normalize_memo_max_size = 16 * 2**20,
+    # Pack file written by `pack-tests.py` to read the tests from instead of `test_dir`, if not empty.
+    test_pack = '',
 )
 try:
     config_custom = imp.load_source(config_file_noext, config_file).config
@@ -21,6 +55,9 @@ except IOError:
     # Config file not present.
     pass
 
+# Seconds to wait for other processes which write to the same SQLite file, e.g. a `--watch` session.
+sqlite_timeout = 60
+
 # Encoding of all out outputs when we can chose it, hopefully equal to most inputs.
 encoding = 'utf-8'
 in_ext = u".md"
@@ -37,7 +74,558 @@ def same_basename_on_parent(path):
     path_split = path.split(os.sep)
     return os.sep.join(path_split[0:-2] + [path_split[-1]])
 
-def io_iterator():
+class TestCase(object):
+    """
+    A test of a `TestSource`, whose input and output are only read from the source when used.
+
+    `key` locates them in the source, e.g. their paths or their offset in a pack,
+    so that a test only costs its name and key until it runs, however many engines run it.
+    """
+    __slots__ = ('name', 'source', 'key')
+
+    def __init__(self, name, source, key):
+        self.name = name
+        self.source = source
+        self.key = key
+
+    @property
+    def input(self):
+        return self.source.read_input(self.key)
+
+    @property
+    def output(self):
+        """
+        Expected output, `None` for examples which have none.
+        """
+        return self.source.read_output(self.key)
+
+    def normalized_output(self, index):
+        """
+        Normalized expected output from a `NormalizedOutputIndex`.
+        """
+        return self.source.normalized_output(self.key, index)
+
+    def io(self, index=None):
+        """
+        Tuple `(name, input, output)` as yielded by `io_iterator`, with the normalized output if `index` is given.
+        """
+        io = (self.name, self.input, self.output)
+        if index is not None:
+            io += (self.normalized_output(index),)
+        return io
+
+class TestSource(object):
+    """
+    Source of input output pairs, e.g. a test directory, a spec document or a packed file.
+
+    Subclasses set `tests` to a list of `TestCase` of the Original markdown,
+    and `engine_tests` to a dict of such lists by engine id.
+
+    By default, the key of each `TestCase` is the tuple `(input, output)`.
+    """
+    tests = ()
+    engine_tests = {}
+
+    def engine_ids(self):
+        return sorted(self.engine_tests)
+
+    def read_input(self, key):
+        return key[0]
+
+    def read_output(self, key):
+        return key[1]
+
+    def normalized_output(self, key, index):
+        output = self.read_output(key)
+        if output is None:
+            return None
+        return index.get_content(output)
+
+    def iterate(self, tests, index=None):
+        for test in tests:
+            yield test.io(index)
+
+    def io_iterator(self, index=None):
+        return self.iterate(self.tests, index)
+
+    def io_iterator_engine(self, id, index=None):
+        return self.iterate(self.engine_tests.get(id, ()), index)
+
+class Corpus(TestSource):
+    """
+    All tests under a test directory.
+
+    The directory tree is scanned once on creation, and the fallbacks of engine tests
+    to the files directly under `extensions/` are resolved then.
+
+    File contents are read lazily on first use and kept in a table shared by all iterators,
+    so iterating over the tests of many engines reads each file only once.
+
+    The key of each `TestCase` is the tuple `(input_path, output_path)`.
+    """
+    def __init__(self, test_dir=test_dir):
+        self.test_dir = test_dir
+        self.engines_dir = os.path.join(test_dir, u"extensions")
+        self.contents = {}
+        self.scan()
+
+    def scan(self):
+        self.tests = self.scan_dir(self.test_dir)
+        self.engine_tests = {}
+        for basename in sorted(os.listdir(self.engines_dir)):
+            engine_dir = os.path.join(self.engines_dir, basename)
+            if os.path.isdir(engine_dir):
+                self.engine_tests[basename] = self.scan_dir(engine_dir, fallback=True)
+
+    def rescan(self, paths):
+        """
+        Scan the directory tree again after the files at `paths` changed, and forget their contents.
+        """
+        for path in paths:
+            self.contents.pop(path, None)
+        self.scan()
+
+    def scan_dir(self, directory, fallback=False):
+        """
+        Return the sorted list of `TestCase` of a directory.
+
+        If `fallback`, empty or missing files are replaced by the file of same basename on the parent directory.
+        """
+        tests = []
+        basenames = os.listdir(directory)
+        basename_set = set(basenames)
+        for basename in sorted(basenames):
+            name, ext = os.path.splitext(basename)
+            if ext != in_ext:
+                continue
+            input_path = os.path.join(directory, basename)
+            if not os.path.isfile(input_path):
+                continue
+            output_path = os.path.join(directory, name + out_ext)
+            if fallback:
+                if os.path.getsize(input_path) == 0:
+                    input_path = same_basename_on_parent(input_path)
+                if not name + out_ext in basename_set:
+                    output_path = same_basename_on_parent(output_path)
+            tests.append(TestCase(name, self, (input_path, output_path)))
+        return tests
+
+    def read(self, path):
+        """
+        Decoded content of a file, read only once.
+        """
+        content = self.contents.get(path)
+        if content is None:
+            with open(path, "r") as content_file:
+                content = content_file.read().decode(encoding)
+            self.contents[path] = content
+        return content
+
+    def read_input(self, key):
+        return self.read(key[0])
+
+    def read_output(self, key):
+        return self.read(key[1])
+
+    def normalized_output(self, key, index):
+        return index.get(key[1], self.read(key[1]))
+
+class SpecParser(HTMLParser.HTMLParser):
+    """
+    Extract the examples of a spec document.
+
+    Two styles are understood:
+
+    - `<pre class="example">` as in `markdown-spec.html`, optionally followed by a `<pre>`
+        with the expected output before the next example or heading.
+    - `<div class="example">` containing a `<pre><code class="language-markdown">`
+        and a `<pre><code class="language-html">` as in the CommonMark spec.
+
+    Visible whitespace markers `\u2420` and `\u2192` are replaced by a space and a tab.
+
+    `examples` is a list of `[heading, input, output]`.
+    """
+    markers = {u'\u2420': u' ', u'\u2192': u'\t'}
+
+    def __init__(self):
+        HTMLParser.HTMLParser.__init__(self)
+        self.examples = []
+        self.heading = u''
+        # Last example of the current heading which still has no output.
+        self.last = None
+        # Pieces of the content of the current `pre`, `None` outside of it.
+        self.capture = None
+        self.kind = None
+        self.in_heading = False
+        # Depth of nested `div` in the current example `div`, 0 outside of it.
+        self.example_div_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        classes = (dict(attrs).get('class') or '').split()
+        if self.capture is not None:
+            if tag == 'code' and not self.capture:
+                if 'language-markdown' in classes:
+                    self.kind = 'example'
+                elif 'language-html' in classes:
+                    self.kind = 'output'
+            else:
+                self.capture.append(self.get_starttag_text())
+        elif tag in ('h1', 'h2', 'h3'):
+            self.in_heading = True
+            self.heading = u''
+            self.last = None
+        elif tag == 'div' and (self.example_div_depth or 'example' in classes):
+            self.example_div_depth += 1
+        elif tag == 'pre':
+            self.capture = []
+            if 'example' in classes:
+                self.kind = 'example'
+            elif self.example_div_depth:
+                self.kind = None
+            else:
+                self.kind = 'output'
+
+    def handle_endtag(self, tag):
+        if tag == 'pre' and self.capture is not None:
+            content = u''.join(self.capture)
+            if content.startswith(u'\n'):
+                content = content[1:]
+            for marker, replacement in self.markers.items():
+                content = content.replace(marker, replacement)
+            if self.kind == 'example':
+                self.last = [self.heading, content, None]
+                self.examples.append(self.last)
+            elif self.kind == 'output' and self.last is not None:
+                self.last[2] = content
+                self.last = None
+            self.capture = None
+        elif self.capture is not None:
+            if tag != 'code':
+                self.capture.append(u'</{}>'.format(tag))
+        elif tag in ('h1', 'h2', 'h3'):
+            self.in_heading = False
+        elif tag == 'div' and self.example_div_depth:
+            self.example_div_depth -= 1
+            if not self.example_div_depth:
+                self.last = None
+
+    def handle_data(self, data):
+        if self.capture is not None:
+            self.capture.append(data)
+        elif self.in_heading:
+            self.heading += data
+
+    def handle_entityref(self, name):
+        self.handle_data(self.unescape(u'&{};'.format(name)))
+
+    def handle_charref(self, name):
+        self.handle_data(self.unescape(u'&#{};'.format(name)))
+
+def slug(string):
+    """
+        >>> slug(u' Standalone Paragraph!')
+        u'standalone-paragraph'
+    """
+    return u'-'.join(re.findall(r'[a-z0-9]+', string.lower()))
+
+class FileSource(TestSource):
+    """
+    Tests parsed from a single file.
+
+    Test names are prefixed by the basename of the file without extension, e.g. `markdown-spec/`.
+
+    Since parsing can be slow, the parsed tests are cached under `cache_dir`
+    until the modification time or the size of the file changes.
+    """
+    # Change to invalidate the caches of a subclass when its parsing changes.
+    parser_version = 1
+
+    def __init__(self, path, cache=True):
+        self.path = path
+        basename = os.path.basename(path)
+        for ext in self.exts:
+            if basename.endswith(ext):
+                basename = basename[:-len(ext)]
+        self.prefix = basename + u'/'
+        self.load(cache)
+
+    def load(self, cache):
+        stat = os.stat(self.path)
+        key = [type(self).__name__, self.parser_version, stat.st_mtime, stat.st_size]
+        cache_path = os.path.join(config['cache_dir'], 'sources',
+                hashlib.sha1(os.path.abspath(self.path).encode(encoding)).hexdigest() + '.json.gz')
+        data = None
+        if cache:
+            try:
+                with gzip.open(cache_path, 'rb') as cache_file:
+                    data = json.load(cache_file)
+            except (IOError, ValueError):
+                pass
+        if data is None or data.get('key') != key:
+            tests, engine_tests = self.parse()
+            data = {'key': key, 'tests': tests, 'engine_tests': engine_tests}
+            if cache:
+                directory = os.path.dirname(cache_path)
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+                with gzip.open(cache_path, 'wb') as cache_file:
+                    json.dump(data, cache_file, separators=(',', ':'))
+        self.tests = [TestCase(name, self, (input, output)) for name, input, output in data['tests']]
+        self.engine_tests = dict((id, [TestCase(name, self, (input, output)) for name, input, output in tests])
+                for id, tests in data['engine_tests'].items())
+
+    def parse(self):
+        """
+        Return `(tests, engine_tests)` like the `tests` and `engine_tests` attributes,
+        but with tuples `(name, input, output)` instead of `TestCase`.
+        """
+        raise NotImplementedError
+
+class SpecSource(FileSource):
+    """
+    Examples of a spec document such as `markdown-spec.html`, named after the heading they are under:
+    `markdown-spec/standalone-paragraph-1`.
+    """
+    exts = (u'.html', u'.htm')
+
+    def parse(self):
+        parser = SpecParser()
+        with open(self.path, 'r') as spec_file:
+            parser.feed(spec_file.read().decode(encoding))
+        parser.close()
+        tests = []
+        counts = collections.Counter()
+        for heading, input, output in parser.examples:
+            name = slug(heading) or u'example'
+            counts[name] += 1
+            tests.append((u'{}{}-{}'.format(self.prefix, name, counts[name]), input, output))
+        return tests, {}
+
+class PackedSource(FileSource):
+    """
+    Tests packed into a single file, either:
+
+    - JSON lines of the form `{"name": ..., "input": ..., "output": ..., "engine": ...}`,
+        where `engine` is omitted for the Original markdown.
+    - a tar archive, optionally compressed, laid out like `test_dir`, e.g. made with:
+
+            tar czf tests.tar.gz -C tests .
+    """
+    exts = (u'.jsonl', u'.tar', u'.tar.gz', u'.tgz', u'.tar.bz2')
+
+    def parse(self):
+        if self.path.endswith(u'.jsonl'):
+            return self.parse_jsonl()
+        return self.parse_tar()
+
+    def parse_jsonl(self):
+        tests = []
+        engine_tests = {}
+        with open(self.path, 'r') as packed_file:
+            for line in packed_file:
+                if not line.strip():
+                    continue
+                test = json.loads(line)
+                engine = test.get('engine')
+                if engine is None:
+                    target = tests
+                else:
+                    target = engine_tests.setdefault(engine, [])
+                target.append((self.prefix + test['name'], test['input'], test.get('output')))
+        return tests, engine_tests
+
+    def parse_tar(self):
+        contents = {}
+        with tarfile.open(self.path, 'r:*') as archive:
+            for member in archive.getmembers():
+                # Engine outputs are often symlinks to other outputs, which `extractfile` follows.
+                if member.isfile() or member.issym() or member.islnk():
+                    content_file = archive.extractfile(member)
+                    if content_file is not None:
+                        path = os.path.normpath(member.name.decode(encoding))
+                        contents[path] = content_file.read().decode(encoding)
+        tests = []
+        engine_tests = {}
+        for path in sorted(contents):
+            directory, basename = os.path.split(path)
+            name, ext = os.path.splitext(basename)
+            if ext != in_ext:
+                continue
+            input = contents[path]
+            output = contents.get(os.path.join(directory, name + out_ext))
+            if directory == u'':
+                tests.append((self.prefix + name, input, output))
+            elif os.path.dirname(directory) == u'extensions':
+                # Same fallbacks as `Corpus.scan_dir`.
+                if not input:
+                    input = contents.get(same_basename_on_parent(path), input)
+                if output is None:
+                    output = contents.get(same_basename_on_parent(os.path.join(directory, name + out_ext)))
+                engine_tests.setdefault(os.path.basename(directory), []).append((self.prefix + name, input, output))
+        return tests, engine_tests
+
+pack_format = u'markdown-testsuite-pack'
+pack_ext = u'.pack'
+# Fixed size, so that the offset of the index can be written once all tests are.
+pack_header = u'{{"format":"{}","version":1,"index":{:>20}}}\n'
+
+class IndexedPackSource(TestSource):
+    """
+    Tests of a pack file written by `pack`, which loads with a single read instead of one per file.
+    Unlike the JSON lines of `PackedSource`, the pack is indexed so that tests are only decoded when used.
+
+    A pack is made of JSON lines:
+
+    - a header of fixed size with the byte offset of the index line
+    - one line per test in the format of `PackedSource`, with the fallbacks of engine tests already resolved
+    - an index line `{"engines": [...], "tests": [[engine, name, offset, length], ...]}`
+        where `engine` is `null` for the Original markdown.
+
+    Unlike other file sources, test names are not prefixed if `prefix` is empty,
+    so that a pack of `test_dir` can stand for it.
+
+    The pack is kept in memory as is, and the key of each `TestCase` is the `(offset, length)` of its line,
+    which is only decoded when the test is used.
+    """
+    exts = (pack_ext,)
+
+    def __init__(self, path, cache=True, prefix=None):
+        self.path = path
+        if prefix is None:
+            prefix = os.path.basename(path)[:-len(pack_ext)] + u'/'
+        self.prefix = prefix
+        with open(path, 'rb') as pack_file:
+            data = pack_file.read()
+        header = json.loads(data[:data.find('\n') + 1] or 'null')
+        if not isinstance(header, dict) or header.get('format') != pack_format:
+            raise ValueError(u'Not a test pack: {}'.format(path))
+        index = json.loads(data[header['index']:])
+        self.data = data
+        # Last decoded `(key, test)`, since the input and output of a test are usually read together.
+        self.last = (None, None)
+        self.tests = []
+        self.engine_tests = dict((id, []) for id in index['engines'])
+        for engine, name, offset, length in index['tests']:
+            test = TestCase(prefix + name, self, (offset, length))
+            if engine is None:
+                self.tests.append(test)
+            else:
+                self.engine_tests[engine].append(test)
+
+    def decode(self, key):
+        last_key, test = self.last
+        if last_key != key:
+            offset, length = key
+            test = json.loads(self.data[offset:offset + length])
+            self.last = (key, test)
+        return test
+
+    def read_input(self, key):
+        return self.decode(key)['input']
+
+    def read_output(self, key):
+        return self.decode(key).get('output')
+
+def pack(path, source=None):
+    """
+    Write all tests of `source`, by default the `Corpus` of `test_dir`, to the pack file `path`.
+    """
+    if source is None:
+        source = Corpus()
+    offset = len(pack_header.format(pack_format, 0))
+    lines = []
+    tests = []
+    suites = [(None, source.io_iterator())]
+    suites.extend((id, source.io_iterator_engine(id)) for id in source.engine_ids())
+    for engine, ios in suites:
+        for name, input, output in ios:
+            test = {'name': name, 'input': input, 'output': output}
+            if engine is not None:
+                test['engine'] = engine
+            # ASCII, so that lengths are in bytes.
+            line = json.dumps(test, sort_keys=True) + '\n'
+            tests.append([engine, name, offset, len(line)])
+            lines.append(line)
+            offset += len(line)
+    tmp_path = path + u'.tmp'
+    with open(tmp_path, 'wb') as pack_file:
+        pack_file.write(pack_header.format(pack_format, offset))
+        pack_file.writelines(lines)
+        pack_file.write(json.dumps({'engines': source.engine_ids(), 'tests': tests}, separators=(',', ':')) + '\n')
+    os.rename(tmp_path, path)
+    return len(tests)
+
+def unpack(path, directory):
+    """
+    Write the tests of the pack file `path` into `directory`, laid out like `test_dir`.
+
+    Engine tests are written in full, since their fallbacks are resolved in the pack.
+    """
+    source = IndexedPackSource(path, prefix=u'')
+    suites = [(directory, source.tests)]
+    suites.extend((os.path.join(directory, u'extensions', id), source.engine_tests[id]) for id in source.engine_ids())
+    os.makedirs(os.path.join(directory, u'extensions'))
+    for suite_dir, tests in suites:
+        if not os.path.isdir(suite_dir):
+            os.makedirs(suite_dir)
+        for name, input, output in source.iterate(tests):
+            with open(os.path.join(suite_dir, name + in_ext), 'w') as input_file:
+                input_file.write(input.encode(encoding))
+            if output is not None:
+                with open(os.path.join(suite_dir, name + out_ext), 'w') as output_file:
+                    output_file.write(output.encode(encoding))
+    return sum(len(tests) for suite_dir, tests in suites)
+
+def open_source(path, cache=True):
+    """
+    Open a test directory, spec document, packed file or pack as a `TestSource` according to its type.
+    """
+    if os.path.isdir(path):
+        return Corpus(path)
+    for source_class in (SpecSource, PackedSource, IndexedPackSource):
+        if any(path.endswith(ext) for ext in source_class.exts):
+            return source_class(path, cache)
+    raise ValueError(u'Unknown test source type: {}'.format(path))
+
+# Sources iterated by the module level iterators after the shared `Corpus`.
+sources = []
+
+def add_source(path, cache=True):
+    sources.append(open_source(path, cache))
+
+_corpus = None
+def get_corpus():
+    """
+    The `Corpus` of `test_dir` shared by the module level iterators, created on first use,
+    or the `IndexedPackSource` of `test_pack` if configured.
+    """
+    global _corpus
+    if _corpus is None:
+        if config['test_pack']:
+            _corpus = IndexedPackSource(config['test_pack'], prefix=u'')
+        else:
+            _corpus = Corpus()
+    return _corpus
+
+def test_cases():
+    """
+    List of the `TestCase` of the Original markdown of all sources, in the order of `io_iterator`.
+    """
+    cases = []
+    for source in [get_corpus()] + sources:
+        cases.extend(source.tests)
+    return cases
+
+def test_cases_engine(id):
+    """
+    List of the `TestCase` of a given engine, in the order of `io_iterator_engine`.
+    """
+    cases = []
+    for source in [get_corpus()] + sources:
+        cases.extend(source.engine_tests.get(id, ()))
+    return cases
+
+def io_iterator(index=None):
     """
     Iterator over all input output pairs of the Original markdown, no engines.
 
@@ -45,63 +633,437 @@ def io_iterator():
 
     - `path` is the path of the test relative to the `test_dir` and without engine (`.md` or `.out`).
     - `input` and `output` are the content of the input and output files.
+
+    If a `NormalizedOutputIndex` is given, each yield is a 4-tuple with the normalized output appended.
+
+    Tests of the sources added with `add_source` follow those of `test_dir`,
+    and `output` is `None` for those which have no expected output.
     """
-    for basename in sorted(os.listdir(test_dir)):
-        input_path = os.path.join(test_dir, basename)
-        if os.path.isfile(input_path):
-            path_noext, ext = os.path.splitext(input_path)
-            if ext == in_ext:
-                with open(input_path, "r") as input_file:
-                    input = input_file.read().decode(encoding)
-                output_path = path_noext + out_ext
-                with open(output_path, "r") as output_file:
-                    output = output_file.read().decode(encoding)
-                yield (os.path.splitext(basename)[0], input, output)
+    for test in test_cases():
+        yield test.io(index)
 
-def io_iterator_engine(id):
+def io_iterator_engine(id, index=None):
     """
     Iterator over all input output pairs of a given engine.
 
     Original markdown is not included.
     """
-    engine_dir = os.path.join(engines_dir, id)
-    for basename in sorted(os.listdir(engine_dir)):
-        input_path = os.path.join(engine_dir, basename)
-        if os.path.isfile(input_path):
-            path_noext, ext = os.path.splitext(input_path)
-            if ext == in_ext:
-                # Get input
-                with open(input_path, "r") as input_file:
-                    input = input_file.read().decode(encoding)
-                if not input:
-                    with open(same_basename_on_parent(input_path), "r") as input_file:
-                        input = input_file.read().decode(encoding)
-                # Get output
-                output_path = path_noext + out_ext
-                if not os.path.exists(output_path):
-                    output_path = same_basename_on_parent(output_path)
-                with open(output_path, "r") as output_file:
-                    output = output_file.read().decode(encoding)
-                yield (os.path.splitext(basename)[0], input, output)
+    for test in test_cases_engine(id):
+        yield test.io(index)
 
 def get_engine_ids():
     """
     Returns a sorted list of ids of all supported engines
-    based on the directories present under the engines directory.
+    based on the directories present under the engines directory, and the engines of added sources.
     """
-    output = []
-    for basename in sorted(os.listdir(engines_dir)):
-        path = os.path.join(engines_dir, basename)
-        if os.path.isdir(path):
-            output.append(basename)
-    return output
+    ids = set(get_corpus().engine_ids())
+    for source in sources:
+        ids.update(source.engine_ids())
+    return sorted(ids)
 
-def io_iterator_all_engines():
+def io_iterator_all_engines(index=None):
     """
     Iterator over all input output pairs of a all engines
 
     Original markdown is not included.
     """
     for id in get_engine_ids():
-        for io in io_iterator_engine(id):
+        for io in io_iterator_engine(id, index):
             yield io
+
+def output_paths():
+    """
+    Sorted list of the paths of all output files, including those of engines.
+    """
+    output = []
+    for directory, dirnames, basenames in os.walk(test_dir):
+        for basename in basenames:
+            if os.path.splitext(basename)[1] == out_ext:
+                output.append(os.path.join(directory, basename))
+    return sorted(output)
+
+class NormalizedOutputIndex(object):
+    """
+    Normalized form of output files, stored in a gzipped JSON file so that they are not
+    normalized again for each engine and each run.
+
+    An entry is reused if either the modification time or the SHA-1 of its file is unchanged.
+    The whole index is dropped if `version`, which identifies the normalization, changes.
+    """
+    def __init__(self, path, normalize, version):
+        self.path = path
+        self.normalize = normalize
+        self.version = version
+        self.entries = {}
+        # Paths already checked against their files by this process.
+        self.checked = set()
+        self.dirty = False
+        try:
+            with gzip.open(path, 'rb') as index_file:
+                data = json.load(index_file)
+        except (IOError, ValueError):
+            data = None
+        if data is not None and data.get('version') == version:
+            self.entries = data['entries']
+
+    def get(self, output_path, output=None):
+        """
+        Return the normalized form of the given output file.
+
+        `output` is the decoded content of the file if already read.
+        """
+        entry = self.entries.get(output_path)
+        if entry is not None and output_path in self.checked:
+            return entry[2]
+        self.checked.add(output_path)
+        mtime = os.path.getmtime(output_path)
+        if entry is not None and entry[0] == mtime:
+            return entry[2]
+        if output is None:
+            with open(output_path, "r") as output_file:
+                output = output_file.read().decode(encoding)
+        sha1 = hashlib.sha1(output.encode(encoding)).hexdigest()
+        if entry is None or entry[1] != sha1:
+            entry = [mtime, sha1, self.normalize(output)]
+        else:
+            entry[0] = mtime
+        self.entries[output_path] = entry
+        self.dirty = True
+        return entry[2]
+
+    def forget(self, paths):
+        """
+        Check the entries of the given output files against their files again on next use, e.g. after they changed.
+        """
+        self.checked.difference_update(paths)
+
+    def get_content(self, output):
+        """
+        Return the normalized form of an output which is not read from a file, e.g. from a pack.
+        """
+        sha1 = hashlib.sha1(output.encode(encoding)).hexdigest()
+        key = u'sha1:' + sha1
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = [None, sha1, self.normalize(output)]
+            self.entries[key] = entry
+            self.dirty = True
+        return entry[2]
+
+    def build(self):
+        """
+        Make the index up to date with all output files, and remove entries of deleted files.
+        """
+        paths = output_paths()
+        for output_path in paths:
+            self.get(output_path)
+        for output_path in set(self.entries) - set(paths):
+            if not output_path.startswith(u'sha1:'):
+                del self.entries[output_path]
+                self.dirty = True
+
+    def save(self):
+        if self.dirty:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            with gzip.open(self.path, 'wb') as index_file:
+                json.dump({'version': self.version, 'entries': self.entries}, index_file, separators=(',', ':'))
+            self.dirty = False
+
+class OutputCache(object):
+    """
+    On disk cache of engine outputs, with least recently used eviction.
+
+    Outputs are keyed by `(engine_id, fingerprint, sha256(input))`,
+    where `fingerprint` must change whenever the engine version changes.
+    Each output is stored with the time the engine took to produce it, if known.
+
+    The last use times of hits are only written with the next `put` or on `close`,
+    so that reads never hold the write lock of the file, which other processes may share.
+
+    Can be shared across threads.
+    """
+    def __init__(self, path, max_size, refresh=False):
+        """
+        If `refresh` is true, cached outputs are never returned, only overwritten.
+        """
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.connection = sqlite3.connect(path, timeout=sqlite_timeout, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS outputs ("
+            "engine TEXT, fingerprint TEXT, input_hash TEXT, output TEXT, size INTEGER, last_used REAL, "
+            "engine_time REAL, PRIMARY KEY (engine, fingerprint, input_hash))"
+        )
+        if 'engine_time' not in [row[1] for row in self.connection.execute("PRAGMA table_info(outputs)")]:
+            self.connection.execute("ALTER TABLE outputs ADD COLUMN engine_time REAL")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS outputs_last_used ON outputs (last_used)")
+        self.connection.commit()
+        self.lock = threading.Lock()
+        self.max_size = max_size
+        self.refresh = refresh
+        self.size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM outputs").fetchone()[0]
+        # Last use time by key of the hits not written yet.
+        self.used = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def hash_input(input):
+        return hashlib.sha256(input.encode(encoding)).hexdigest()
+
+    def get(self, engine_id, fingerprint, input):
+        """
+        Return a 2-tuple `(output, engine_time)` of the cached output, or `None` if not present.
+        """
+        key = (engine_id, fingerprint, self.hash_input(input))
+        with self.lock:
+            row = None
+            if not self.refresh:
+                row = self.connection.execute(
+                    "SELECT output, engine_time FROM outputs WHERE engine = ? AND fingerprint = ? AND input_hash = ?",
+                    key
+                ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.used[key] = time.time()
+            return row
+
+    def put(self, engine_id, fingerprint, input, output, engine_time=None):
+        key = (engine_id, fingerprint, self.hash_input(input))
+        size = len(output.encode(encoding))
+        with self.lock:
+            self.write_used()
+            row = self.connection.execute(
+                "SELECT size FROM outputs WHERE engine = ? AND fingerprint = ? AND input_hash = ?",
+                key
+            ).fetchone()
+            if row is not None:
+                self.size -= row[0]
+            self.connection.execute(
+                "INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?, ?, ?, ?)",
+                key + (output, size, time.time(), engine_time)
+            )
+            self.size += size
+            self.evict()
+            self.connection.commit()
+
+    def write_used(self):
+        self.connection.executemany(
+            "UPDATE outputs SET last_used = ? WHERE engine = ? AND fingerprint = ? AND input_hash = ?",
+            ((last_used,) + key for key, last_used in self.used.iteritems())
+        )
+        self.used = {}
+
+    def evict(self):
+        """
+        Remove least recently used outputs until the cache fits into `max_size`.
+        """
+        while self.size > self.max_size:
+            rows = self.connection.execute(
+                "SELECT engine, fingerprint, input_hash, size FROM outputs ORDER BY last_used LIMIT 64"
+            ).fetchall()
+            if not rows:
+                self.size = 0
+                break
+            for row in rows:
+                if self.size <= self.max_size:
+                    break
+                self.connection.execute(
+                    "DELETE FROM outputs WHERE engine = ? AND fingerprint = ? AND input_hash = ?",
+                    row[:3]
+                )
+                self.size -= row[3]
+
+    def close(self):
+        with self.lock:
+            self.write_used()
+            self.connection.commit()
+            self.connection.close()
+
+# `output` is the raw output of the engine for failed tests, and `error` the message of an engine limit error.
+# `engine_time` is the time the engine took, even if the output was cached and `elapsed_time` is that of the cache.
+StoredResult = collections.namedtuple('StoredResult',
+        'fingerprint marker output error elapsed_time peak_memory engine_time')
+
+class ResultStore(object):
+    """
+    Last result of each test of each engine, stored in SQLite.
+
+    Results are keyed by `(engine_id, suite, path)`, where `suite` distinguishes the Original markdown tests
+    from the extension tests. Each result has a `fingerprint` which the caller uses to decide if it is still valid.
+
+    Stores of an older layout are emptied, since results can always be computed again.
+
+    Not thread safe.
+    """
+    max_pending = 100
+    max_pending_time = 1
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.connection = sqlite3.connect(path, timeout=sqlite_timeout)
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(results)")]
+        if columns and columns[3:] != list(StoredResult._fields):
+            self.connection.execute("DROP TABLE results")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "engine TEXT, suite TEXT, path TEXT, fingerprint TEXT, marker TEXT, output TEXT, error TEXT, "
+            "elapsed_time REAL, peak_memory INTEGER, engine_time REAL, PRIMARY KEY (engine, suite, path))"
+        )
+        self.connection.commit()
+        self.pending = 0
+        self.pending_time = None
+
+    def get(self, engine_id, suite, path):
+        """
+        Return a `StoredResult`, or `None` if the test never ran.
+        """
+        row = self.connection.execute(
+            "SELECT fingerprint, marker, output, error, elapsed_time, peak_memory, engine_time FROM results "
+            "WHERE engine = ? AND suite = ? AND path = ?",
+            (engine_id, suite, path)
+        ).fetchone()
+        if row is None:
+            return None
+        return StoredResult(*row)
+
+    def engine_times(self, engine_id, suite):
+        """
+        Return a dict of the engine time of the last run of each test path.
+        """
+        return dict(self.connection.execute(
+            "SELECT path, engine_time FROM results WHERE engine = ? AND suite = ?",
+            (engine_id, suite)
+        ))
+
+    def put(self, engine_id, suite, path, result):
+        """
+        Store a `StoredResult`. Results are committed in batches of at most `max_pending` results
+        or `max_pending_time` seconds, since the write lock of the file is held until then.
+        """
+        self.connection.execute(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (engine_id, suite, path) + tuple(result)
+        )
+        self.pending += 1
+        if self.pending_time is None:
+            self.pending_time = time.time()
+        if self.pending >= self.max_pending or time.time() - self.pending_time >= self.max_pending_time:
+            self.commit()
+
+    def commit(self):
+        self.connection.commit()
+        self.pending = 0
+        self.pending_time = None
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+class PollingWatcher(object):
+    """
+    Detects changes of the files under a directory by comparing their modification time and size
+    every `interval` seconds.
+    """
+    def __init__(self, directory, interval=0.2):
+        self.directory = directory
+        self.interval = interval
+        self.stats = self.scan()
+
+    def scan(self):
+        stats = {}
+        for root, dirnames, basenames in os.walk(self.directory):
+            for basename in basenames:
+                path = os.path.join(root, basename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                stats[path] = (stat.st_mtime, stat.st_size)
+        return stats
+
+    def changes(self, timeout=None):
+        """
+        Wait for changes for at most `timeout` seconds, or forever if `None`,
+        and return the set of the paths of the files that were modified, added or removed.
+        """
+        end = None if timeout is None else time.time() + timeout
+        while True:
+            stats = self.scan()
+            changed = set(path for path in set(stats) | set(self.stats) if stats.get(path) != self.stats.get(path))
+            self.stats = stats
+            if changed or (end is not None and time.time() >= end):
+                return changed
+            time.sleep(self.interval if end is None else max(0, min(self.interval, end - time.time())))
+
+class InotifyWatcher(object):
+    """
+    Same as `PollingWatcher`, but notified of changes by the Linux kernel with inotify.
+
+    Raises `OSError` if inotify is not available.
+    """
+    # From `sys/inotify.h`.
+    IN_MODIFY = 0x2
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_ISDIR = 0x40000000
+    mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    event_header = struct.Struct('iIII')
+
+    def __init__(self, directory):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        try:
+            self.inotify_add_watch = libc.inotify_add_watch
+            self.fd = libc.inotify_init()
+        except AttributeError:
+            raise OSError("inotify is not available")
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+        self.directories = {}
+        for root, dirnames, basenames in os.walk(directory):
+            self.add(root)
+
+    def add(self, directory):
+        wd = self.inotify_add_watch(self.fd, directory.encode(sys.getfilesystemencoding()), self.mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed", directory)
+        self.directories[wd] = directory
+
+    def changes(self, timeout=None):
+        changed = set()
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return changed
+        data = os.read(self.fd, 2**16)
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = self.event_header.unpack_from(data, offset)
+            offset += self.event_header.size
+            name = data[offset:offset + length].rstrip('\0').decode(sys.getfilesystemencoding())
+            offset += length
+            if wd in self.directories and name:
+                path = os.path.join(self.directories[wd], name)
+                if mask & self.IN_ISDIR:
+                    if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                        self.add(path)
+                else:
+                    changed.add(path)
+        return changed
+
+def watcher(directory):
+    """
+    An `InotifyWatcher` of `directory` if inotify is available, else a `PollingWatcher`.
+    """
+    try:
+        return InotifyWatcher(directory)
+    except OSError:
+        return PollingWatcher(directory)
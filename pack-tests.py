@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+import argparse
+import os
+
+import md_testsuite
+
+default_pack = u"tests" + md_testsuite.pack_ext
+
+parser = argparse.ArgumentParser(
+    description="Pack all tests into a single file that loads fast, or unpack such a file into a test directory.",
+    epilog=r"""The pack is a JSON lines file with an index of the offset of each test, which is only decoded when used,
+and the fallbacks of engine tests to the files directly under `extensions/` already resolved.
+See `md_testsuite.IndexedPackSource` for the format.
+
+Pack `{test_dir}` into `{pack}`:
+
+    {f} pack
+
+Have `run-tests.py` read tests from the pack by setting `test_pack = '{pack}'` in `{config_file}`.
+
+Unpack it back into a test directory:
+
+    {f} unpack {pack} tests-unpacked
+""".format(f="./pack-tests.py", test_dir=md_testsuite.test_dir, pack=default_pack,
+        config_file=md_testsuite.config_file),
+    formatter_class=argparse.RawTextHelpFormatter, # Keep newlines.
+)
+parser.add_argument(
+    "action",
+    choices=["pack", "unpack"],
+)
+parser.add_argument(
+    "pack",
+    nargs="?",
+    default=default_pack,
+    help="Pack file."
+)
+parser.add_argument(
+    "directory",
+    nargs="?",
+    default=md_testsuite.test_dir,
+    help="""Test directory to pack, or to unpack into. Must not exist when unpacking."""
+)
+args = parser.parse_args()
+
+if args.action == "pack":
+    count = md_testsuite.pack(args.pack, md_testsuite.Corpus(args.directory))
+    print "Packed {} tests into {}".format(count, args.pack)
+else:
+    if os.path.exists(args.directory):
+        parser.error("{} already exists".format(args.directory))
+    count = md_testsuite.unpack(args.pack, args.directory)
+    print "Unpacked {} tests into {}".format(count, args.directory)
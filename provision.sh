@@ -119,6 +119,9 @@ bin_dir='/usr/local/bin'
   cd '..'
   rm -rf -- "$dir"
 
+  # python_markdown
+  sudo pip install 'markdown'
+
   # rdiscount
   gem install 'rdiscount'
 
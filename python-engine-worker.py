@@ -0,0 +1,12 @@
+#!/usr/bin/env python
+# Worker process of `PythonWorker` in `run-tests.py`, which renders many inputs with a Python engine.
+# Usage: python-engine-worker.py engine_name
+# Each input is read on stdin as a JSON string on its own line, and answered on stdout with a JSON line
+# `[status, value]`, where `status` is `output`, `memory` or `error`. Exits on EOF of stdin.
+
+import imp
+import os
+import sys
+
+run_tests = imp.load_source('run_tests', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'run-tests.py'))
+run_tests.python_worker_main(sys.argv[1])
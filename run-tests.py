@@ -1,61 +1,232 @@
 #!/usr/bin/env python
 
 import argparse
+import collections
+import contextlib
+import cProfile
 import distutils.spawn
 from htmlentitydefs import name2codepoint
 from HTMLParser import HTMLParser
+import difflib
+import hashlib
+import httplib
+import imp
+import importlib
+import inspect
 import itertools
 import json
+import math
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import os
+import Queue
+import random
 import re
+import resource
+import signal
+import socket
 import subprocess
 import sys
+import threading
 import time
-import urllib2
+import urlparse
+import zlib
+from xml.sax.saxutils import escape, quoteattr
 
+import md_generate
 import md_testsuite
 from md_testsuite import config
 
+# `md_testsuite.OutputCache` used by `get_output_timed`, if any.
+output_cache = None
+# `md_testsuite.ResultStore` used by `schedule_tests` and `run_tests`, if any.
+result_store = None
+# `md_testsuite.NormalizedOutputIndex` of the expected outputs used by `run_tests`.
+output_index = None
+# Objects with `write(record)` and `close()` methods to which `run_tests` writes each test result.
+result_writers = []
+# `Profiler` of the phases of each test, if any.
+profiler = None
+# `NormalizeMemo` used by `normalize_output`, if any.
+normalize_memo = None
+# Elapsed times of tests by `(engine, suite, path)` used to balance `--shard`, if any. Else taken from `result_store`.
+shard_timings = None
+
+class NoPhase(object):
+    def __enter__(self):
+        pass
+    def __exit__(self, *exc_info):
+        pass
+no_phase = NoPhase()
+
+def phase(name):
+    """
+    Context manager which adds the time spent in its block to the phase `name` of the test
+    that `profiler` is recording in the current thread. Does nothing when not profiling.
+    """
+    if profiler is None:
+        return no_phase
+    return profiler.phase(name)
+
+def count(name, value=1):
+    """
+    Add `value` to the counter `name` of the engine of the test that `profiler` is recording, if any.
+    """
+    if profiler is not None:
+        profiler.count(name, value)
+
+class Profiler(object):
+    """
+    Time spent in each phase of each test, e.g. `spawn` of the engine process or `normalize` of its output,
+    and counters by engine.
+
+    A test is recorded in the thread that runs it between `start` and `stop`, possibly several times.
+    Nested phases only count their own time, and time spent outside of all phases counts as `harness`.
+    """
+    # Display order of known phases.
+    phases = ['cache', 'spawn', 'write', 'engine', 'decode', 'http', 'normalize', 'diff', 'harness']
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        # Phase times by `(engine_name, suite, path)`.
+        self.tests = collections.OrderedDict()
+        # Counters by engine name.
+        self.counters = collections.defaultdict(collections.Counter)
+
+    def start(self, engine_name, suite, path):
+        self.local.test = (engine_name, suite, path)
+        self.local.phases = collections.Counter()
+        # Time spent in the children of each open phase.
+        self.local.stack = []
+        self.local.start_time = time.time()
+
+    def stop(self):
+        """
+        Return the phase times recorded since `start`.
+        """
+        phases = self.local.phases
+        self.local.phases = None
+        phases['harness'] += max(time.time() - self.local.start_time - sum(phases.values()), 0)
+        with self.lock:
+            self.tests.setdefault(self.local.test, collections.Counter()).update(phases)
+        return phases
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        phases = getattr(self.local, 'phases', None)
+        if phases is None:
+            yield
+            return
+        stack = self.local.stack
+        stack.append(0)
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            elapsed_time = time.time() - start_time
+            phases[name] += elapsed_time - stack.pop()
+            if stack:
+                stack[-1] += elapsed_time
+
+    def count(self, name, value):
+        if getattr(self.local, 'phases', None) is not None:
+            with self.lock:
+                self.counters[self.local.test[0]][name] += value
+
+    def engine_phases(self):
+        """
+        Dict of total phase times by engine name.
+        """
+        totals = collections.OrderedDict()
+        for (engine_name, suite, path), phases in self.tests.items():
+            totals.setdefault(engine_name, collections.Counter()).update(phases)
+        return totals
+
+    def format_summary(self):
+        """
+        Table of the total time of each phase by engine, each followed by the counters of the engine.
+        """
+        totals = self.engine_phases()
+        names = set()
+        for phases in totals.values():
+            names.update(name for name, value in phases.items() if value)
+        names = [name for name in self.phases if name in names] + sorted(names - set(self.phases))
+        l = max([len(engine_name) for engine_name in totals] + [0])
+        lines = ["{:<{l}} {}".format("", " ".join("{:>9}".format(name) for name in names), l=l)]
+        for engine_name, phases in totals.items():
+            lines.append("{:<{l}} {}".format(engine_name,
+                    " ".join("{:>8.3f}s".format(phases[name]) for name in names), l=l))
+            counters = self.counters.get(engine_name)
+            if counters:
+                lines.append("{:<{l}} {}".format("", " ".join(
+                        "{}={}".format(name, value) for name, value in sorted(counters.items())), l=l))
+        return "\n".join(lines)
+
+    def write_folded(self, path):
+        """
+        Write total phase times as folded stacks `engine;suite;phase microseconds`, one per line,
+        which flame graph tools take as input.
+        """
+        totals = collections.OrderedDict()
+        for (engine_name, suite, test_path), phases in self.tests.items():
+            for name, value in phases.items():
+                key = "{};{};{}".format(engine_name, suite, name)
+                totals[key] = totals.get(key, 0) + value
+        with open(path, 'w') as folded_file:
+            for key, value in totals.items():
+                folded_file.write("{} {}\n".format(key, int(value * 1e6)))
+
 significant_attrs = ["alt", "href", "src", "title"]
 normalize_whitespace_re = re.compile('\s+')
 class MyHTMLParser(HTMLParser):
+    """
+    Normalizing parser. Normalized tokens are appended to a list and joined once by `output`,
+    so that the cost stays linear on large documents.
+
+    Each tag is a single token, and text may be split into several tokens.
+    """
     def __init__(self):
         HTMLParser.__init__(self)
         self.last = "starttag"
         self.in_pre = False
-        self.output = u""
+        self.tokens = []
+    @property
+    def output(self):
+        return u"".join(self.tokens)
     def handle_data(self, data):
         if self.in_pre:
-            self.output += data
+            self.tokens.append(data)
         else:
             data = normalize_whitespace_re.sub(' ', data)
             data_strip = data.strip()
             if (self.last == "ref") and data_strip and data[0] == " ":
-                self.output += " "
+                self.tokens.append(" ")
             self.data_end_in_space_not_empty = (data[-1] == ' ' and data_strip)
-            self.output += data_strip
+            self.tokens.append(data_strip)
             self.last = "data"
     def handle_endtag(self, tag):
         if tag == "pre":
             self.in_pre = False
-        self.output += "</" + tag + ">"
+        self.tokens.append("</" + tag + ">")
         self.last = "endtag"
     def handle_starttag(self, tag, attrs):
         if tag == "pre":
             self.in_pre = True
-        self.output += "<" + tag
+        token = "<" + tag
         attrs = filter(lambda attr: attr[0] in significant_attrs, attrs)
         if attrs:
             attrs.sort()
             for attr in attrs:
-                self.output += " " + attr[0] + "=" + '"' + attr[1] + '"'
-        self.output += ">"
+                token += " " + attr[0] + "=" + '"' + attr[1] + '"'
+        self.tokens.append(token + ">")
         self.last = "starttag"
     def handle_startendtag(self, tag, attrs):
         """Ignore closing tag for self-closing void elements."""
         self.handle_starttag(tag, attrs)
     def handle_entityref(self, name):
         self.add_space_from_last_data()
-        self.output += unichr(name2codepoint[name])
+        self.tokens.append(unichr(name2codepoint[name]))
         self.last = "ref"
     def handle_charref(self, name):
         self.add_space_from_last_data()
@@ -63,13 +234,112 @@ class MyHTMLParser(HTMLParser):
             c = unichr(int(name[1:], 16))
         else:
             c = unichr(int(name))
-        self.output += c
+        self.tokens.append(c)
         self.last = "ref"
     # Helpers.
     def add_space_from_last_data(self):
         """Maintain the space at: `a <span>b</span>`"""
         if self.last == 'data' and self.data_end_in_space_not_empty:
-            self.output += ' '
+            self.tokens.append(' ')
+
+class StreamNormalizer(object):
+    """
+    Normalize HTML given in chunks, e.g. as they are read from the stdout of an engine.
+
+    `HTMLParser` flushes pending text at the end of each `feed`, and the whitespace normalization
+    depends on how text is split. So each chunk is only fed up to its last `<` or `&`, where the parser
+    splits text anyway, and the rest is held until the next chunk. The result is then the same
+    as that of `normalize_output` on the concatenated chunks.
+    """
+    def __init__(self):
+        self.parser = MyHTMLParser()
+        self.pending = []
+    def feed(self, chunk):
+        split = max(chunk.rfind('<'), chunk.rfind('&'))
+        if split == -1:
+            self.pending.append(chunk)
+        else:
+            self.pending.append(chunk[:split])
+            self.parser.feed(u"".join(self.pending))
+            self.pending = [chunk[split:]]
+    def close(self):
+        """Return the normalized output of all chunks."""
+        self.parser.feed(u"".join(self.pending))
+        self.pending = []
+        self.parser.close()
+        return self.parser.output
+
+class NormalizeMemo(object):
+    """
+    In memory memo of normalized outputs keyed by the SHA-1 of the raw HTML,
+    with least recently used eviction once the total length of the normalized outputs exceeds `max_size`.
+
+    Engines often produce identical outputs for a test, which are then only normalized once.
+
+        >>> memo = NormalizeMemo(12)
+        >>> memo.get(u"<p>a  b</p>", normalize_html)
+        u'<p>a b</p>'
+        >>> memo.get(u"<p>a  b</p>", normalize_html)
+        u'<p>a b</p>'
+        >>> memo.get(u"<p>c</p>", normalize_html)
+        u'<p>c</p>'
+        >>> memo.hits, memo.misses, len(memo.entries)
+        (1, 2, 1)
+
+    Can be shared across threads.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def hash_html(html):
+        if isinstance(html, unicode):
+            html = html.encode(md_testsuite.encoding)
+        return hashlib.sha1(html).digest()
+
+    def get(self, html, normalize):
+        """
+        Return the memoized normalized form of `html`, or compute it with `normalize` and memoize it.
+        """
+        key = self.hash_html(html)
+        with self.lock:
+            normalized = self.entries.pop(key, None)
+            if normalized is not None:
+                self.entries[key] = normalized
+                self.hits += 1
+        if normalized is not None:
+            count('normalize_memo_hits')
+            return normalized
+        normalized = normalize(html)
+        with self.lock:
+            self.misses += 1
+            if len(normalized) <= self.max_size and key not in self.entries:
+                self.entries[key] = normalized
+                self.size += len(normalized)
+                while self.size > self.max_size:
+                    self.size -= len(self.entries.popitem(last=False)[1])
+        return normalized
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.0
+
+def normalize_chunks(chunks):
+    r"""
+    Same as `normalize_output`, but for HTML given as an iterable of chunks.
+
+        >>> normalize_chunks(["<p>a ", " b &l", "t; c</p", "><pre>a  ", "b</pre>"])
+        u'<p>a b < c</p><pre>a  b</pre>'
+    """
+    normalizer = StreamNormalizer()
+    for chunk in chunks:
+        normalizer.feed(chunk)
+    return normalizer.close()
 
 def normalize_output(html):
     r"""
@@ -143,34 +413,574 @@ def normalize_output(html):
 
         >>> normalize_output('<img src="a" alt="a">')
         u'<img alt="a" src="a">'
+
+    Outputs are memoized in `normalize_memo` if any.
+    """
+    if normalize_memo is not None:
+        return normalize_memo.get(html, normalize_html)
+    return normalize_html(html)
+
+def normalize_html(html):
+    """
+    Same as `normalize_output`, but never memoized.
+    """
+    with phase('normalize'):
+        parser = MyHTMLParser()
+        parser.feed(html)
+        parser.close()
+        return parser.output
+
+_normalizer_version = None
+def normalize_tokens(html):
+    """
+    Same as `normalize_output`, but return the list of non-empty normalized tokens.
+
+        >>> normalize_tokens(u'<p>a <a href="b" id="c">b</a></p>')
+        [u'<p>', u'a', u'<a href="b">', u'b', u'</a>', u'</p>']
     """
-    parser = MyHTMLParser()
-    parser.feed(html)
-    parser.close()
-    return parser.output
+    with phase('normalize'):
+        parser = MyHTMLParser()
+        parser.feed(html)
+        parser.close()
+        return [token for token in parser.tokens if token]
+
+def common_prefix_length(a, b):
+    """
+    Length of the common prefix of two sequences.
+
+    Compares chunks of doubling size first, so that long equal prefixes are skipped by fast slice comparisons.
+
+        >>> common_prefix_length("abcd", "abxd")
+        2
+        >>> common_prefix_length([1, 2], [1, 2, 3])
+        2
+    """
+    n = min(len(a), len(b))
+    i = 0
+    step = 1
+    while i < n:
+        step = min(step, n - i)
+        if a[i:i + step] == b[i:i + step]:
+            i += step
+            step *= 2
+        elif step == 1:
+            break
+        else:
+            step = 1
+    return i
+
+def first_difference(actual_tokens, expected_tokens, context=3, max_tokens=50, max_token_length=80):
+    """
+    Describe where two normalized token lists differ.
+
+    Common prefixes and suffixes are skipped, and only a bounded window of the differing tokens is diffed,
+    so the cost of the diff does not grow with the size of the documents.
+
+        >>> print first_difference(['<p>', 'a', '</p>'], ['<p>', 'b', '</p>']),
+        First difference at token 1, character 3:
+          '<p>'
+        - 'a'
+        + 'b'
+          '</p>'
+        >>> print first_difference(['a', '<br>'], ['<br>']),
+        First difference at token 0, character 0:
+        - 'a'
+          '<br>'
+    """
+    prefix = common_prefix_length(actual_tokens, expected_tokens)
+    max_suffix = min(len(actual_tokens), len(expected_tokens)) - prefix
+    suffix = min(common_prefix_length(actual_tokens[prefix:][::-1], expected_tokens[prefix:][::-1]), max_suffix)
+    actual_middle = actual_tokens[prefix:len(actual_tokens) - suffix]
+    expected_middle = expected_tokens[prefix:len(expected_tokens) - suffix]
+    character = sum(len(token) for token in actual_tokens[:prefix])
+    def format_token(token):
+        if len(token) > max_token_length:
+            token = token[:max_token_length]
+            return repr(token) + '...'
+        return repr(token)
+    def format_changed_tokens(sign, tokens, other_tokens):
+        """Changed tokens. Long tokens are shown from their first differing character."""
+        lines = []
+        for i, token in enumerate(tokens[:max_tokens]):
+            if i == 0 and other_tokens and len(token) > max_token_length:
+                start = max(0, common_prefix_length(token, other_tokens[0]) - max_token_length // 2)
+                lines.append(sign + ' [{}:] '.format(start) + format_token(token[start:]))
+            else:
+                lines.append(sign + ' ' + format_token(token))
+        if len(tokens) > max_tokens:
+            lines.append(sign + ' ... {} more tokens'.format(len(tokens) - max_tokens))
+        return lines
+    lines = ['First difference at token {}, character {}:'.format(prefix, character)]
+    lines.extend('  ' + format_token(token) for token in actual_tokens[max(0, prefix - context):prefix])
+    if len(actual_middle) <= max_tokens and len(expected_middle) <= max_tokens:
+        matcher = difflib.SequenceMatcher(None, actual_middle, expected_middle, autojunk=False)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == 'equal':
+                lines.extend('  ' + format_token(token) for token in actual_middle[i1:i2])
+            else:
+                lines.extend(format_changed_tokens('-', actual_middle[i1:i2], expected_middle[j1:j2]))
+                lines.extend(format_changed_tokens('+', expected_middle[j1:j2], actual_middle[i1:i2]))
+    else:
+        lines.extend(format_changed_tokens('-', actual_middle, expected_middle))
+        lines.extend(format_changed_tokens('+', expected_middle, actual_middle))
+    lines.extend('  ' + format_token(token) for token in actual_tokens[len(actual_tokens) - suffix:][:context])
+    return '\n'.join(lines) + '\n'
+
+def normalizer_version():
+    """
+    Identifier of the current normalization, which changes whenever its code does.
+    """
+    global _normalizer_version
+    if _normalizer_version is None:
+        source = inspect.getsource(MyHTMLParser) + repr(significant_attrs) + normalize_whitespace_re.pattern
+        _normalizer_version = hashlib.sha1(source).hexdigest()
+    return _normalizer_version
+
+def bench_normalize(sizes_mb=(1, 2, 4, 8), chunk_size=2**16):
+    """
+    Time `normalize_output` and `normalize_chunks` on HTML of increasing sizes,
+    made by repeating all expected outputs of the tests.
+
+    The time per MB should stay roughly constant as the size grows.
+    """
+    sample = u"".join(io[2] for io in md_testsuite.io_iterator() if io[2] is not None)
+    print "{:>8} {:>12} {:>10} {:>12} {:>10}".format("size", "output", "s/MB", "chunks", "s/MB")
+    for size_mb in sizes_mb:
+        size = size_mb * 2**20
+        html = (sample * (size // len(sample) + 1))[:size]
+        chunks = [html[i:i + chunk_size] for i in xrange(0, len(html), chunk_size)]
+        start_time = time.time()
+        normalize_html(html)
+        output_time = time.time() - start_time
+        start_time = time.time()
+        normalize_chunks(chunks)
+        chunks_time = time.time() - start_time
+        print "{:>6}MB {:>11.2f}s {:>10.3f} {:>11.2f}s {:>10.3f}".format(
+            size_mb, output_time, output_time / size_mb, chunks_time, chunks_time / size_mb)
+
+class EngineLimitError(Exception):
+    """
+    An engine exceeded a resource limit on a single input.
+
+    `marker` is the progress character of tests that raise it.
+    `elapsed_time`, `peak_memory` and `engine_time` are set by `get_output_timed`.
+    """
+    marker = 'E'
+    elapsed_time = 0
+    peak_memory = None
+    engine_time = None
+
+class EngineTimeout(EngineLimitError):
+    marker = 'T'
+
+class EngineMemoryError(EngineLimitError):
+    marker = 'M'
+
+# Resource usage of the last command run by the current thread.
+command_stats = threading.local()
+
+memory_error_re = re.compile(
+    r'MemoryError|out of memory|Cannot allocate memory|failed to allocate|Allocation failed|bad_alloc',
+    re.IGNORECASE
+)
+
+def set_command_limits(cpu=True):
+    """
+    Called in engine processes before exec to apply the `test_*` limits of the config.
+
+    The process is also made a process group leader so that all of its children can be killed at once.
+    """
+    os.setsid()
+    if cpu and config['test_cpu_limit']:
+        resource.setrlimit(resource.RLIMIT_CPU, (config['test_cpu_limit'], config['test_cpu_limit'] + 1))
+    if config['test_memory_limit']:
+        resource.setrlimit(resource.RLIMIT_DATA, (config['test_memory_limit'], config['test_memory_limit']))
+
+def start_kill_timer(process):
+    """
+    Kill the process group of process after `config['test_timeout']`.
+
+    Returns the started `threading.Timer`, or `None` if there is no timeout.
+    The timer has a `fired` attribute which is true if the process was killed.
+    """
+    if not config['test_timeout']:
+        return None
+    def kill():
+        timer.fired = True
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+    timer = threading.Timer(config['test_timeout'], kill)
+    timer.fired = False
+    timer.daemon = True
+    timer.start()
+    return timer
 
 def stdin_stdout_get_output(command, stdin):
     """
     Convenience method for engines that take input on stdin and output to stdout.
 
+    The command is limited by the `test_timeout`, `test_cpu_limit` and `test_memory_limit` of the config.
+    If it exceeds the time or CPU limits, raises `EngineTimeout`.
+    If it fails on a memory error, raises `EngineMemoryError`.
+    A command is considered to fail on a memory error if it says so on stderr,
+    or if its peak memory reached 90% of the limit.
+
     If the command fails, or returns non 0, raises an exception.
+
+    The peak resident memory of the command in bytes is stored on `command_stats.peak_memory`.
     """
-    process = subprocess.Popen(
-        command,
-        shell  = False,
-        stdin  = subprocess.PIPE,
-        stdout = subprocess.PIPE,
-        stderr = subprocess.PIPE,
-        universal_newlines = True
-    )
-    stdout, stderr = process.communicate(stdin)
-    exit_status = process.wait()
+    with phase('spawn'):
+        process = subprocess.Popen(
+            command,
+            shell  = False,
+            stdin  = subprocess.PIPE,
+            stdout = subprocess.PIPE,
+            stderr = subprocess.PIPE,
+            universal_newlines = True,
+            # Else the pipes of commands started by other threads leak into this one,
+            # whose readers would then wait for this command to exit too.
+            close_fds = True,
+            preexec_fn = set_command_limits
+        )
+    count('spawns')
+    timer = start_kill_timer(process)
+    # Not `communicate`, which reaps the process and loses its resource usage.
+    outputs = {}
+    def read(name):
+        outputs[name] = getattr(process, name).read()
+    readers = [threading.Thread(target=read, args=(name,)) for name in ('stdout', 'stderr')]
+    for reader in readers:
+        reader.daemon = True
+        reader.start()
+    # Pipe I/O overlaps with the work of the engine, so both count as `engine`.
+    with phase('engine'):
+        try:
+            process.stdin.write(stdin)
+            process.stdin.close()
+        except IOError:
+            # The command exited without reading all of its input.
+            pass
+        for reader in readers:
+            reader.join()
+        pid, status, rusage = os.wait4(process.pid, 0)
+    if timer is not None:
+        timer.cancel()
+        # So that no timer thread is left waking up when the interpreter exits.
+        timer.join()
+    if os.WIFSIGNALED(status):
+        exit_status = process.returncode = -os.WTERMSIG(status)
+    else:
+        exit_status = process.returncode = os.WEXITSTATUS(status)
+    # Kilobytes on Linux.
+    peak_memory = command_stats.peak_memory = rusage.ru_maxrss * 1024
+    if (timer is not None and timer.fired) or exit_status == -signal.SIGXCPU:
+        raise EngineTimeout('Command exceeded the time limit.')
     if exit_status != 0:
+        if memory_error_re.search(outputs['stderr']) or (
+                config['test_memory_limit'] and peak_memory >= 0.9 * config['test_memory_limit']):
+            raise EngineMemoryError('Command exceeded the memory limit.')
         raise Exception('Command exit status was not 0.')
-    return stdout.decode(md_testsuite.encoding)
+    count('output_bytes', len(outputs['stdout']))
+    with phase('decode'):
+        return outputs['stdout'].decode(md_testsuite.encoding)
+
+class WorkerError(Exception):
+    pass
+
+class Worker(object):
+    """
+    Long lived engine process which converts many inputs.
+
+    Each input is written to the stdin of the process followed by a NUL byte,
+    and the process must write the corresponding output to stdout also followed by a NUL byte.
+    """
+    separator = '\0'
+    def __init__(self, command):
+        with open(os.devnull, 'w') as devnull:
+            self.process = subprocess.Popen(
+                command,
+                shell  = False,
+                stdin  = subprocess.PIPE,
+                stdout = subprocess.PIPE,
+                stderr = devnull,
+                close_fds = True,
+                # CPU time accumulates over all inputs, so only the timeout applies to each of them.
+                preexec_fn = lambda: set_command_limits(cpu=False)
+            )
+        self.buffer = ''
+    def get_output(self, input):
+        try:
+            with phase('write'):
+                self.process.stdin.write(input.encode(md_testsuite.encoding) + self.separator)
+                self.process.stdin.flush()
+        except IOError:
+            raise WorkerError('Worker stdin closed.')
+        # Only search the newly read chunk for the separator, to stay linear on large outputs.
+        chunks = [self.buffer]
+        end = self.buffer.find(self.separator)
+        timer = None
+        if end == -1:
+            timer = start_kill_timer(self.process)
+        try:
+            with phase('engine'):
+                while end == -1:
+                    chunk = os.read(self.process.stdout.fileno(), 65536)
+                    if not chunk:
+                        if timer is not None and timer.fired:
+                            raise EngineTimeout('Worker exceeded the time limit.')
+                        raise WorkerError('Worker exited.')
+                    chunks.append(chunk)
+                    end = chunk.find(self.separator)
+                    if end != -1:
+                        end += sum(len(c) for c in chunks[:-1])
+        finally:
+            # Else the timer could still kill the process group of the worker, or of a process reusing its PID.
+            if timer is not None:
+                timer.cancel()
+                timer.join()
+        self.buffer = ''.join(chunks)
+        output = self.buffer[:end]
+        self.buffer = self.buffer[end + 1:]
+        count('output_bytes', len(output))
+        with phase('decode'):
+            # Same newline translation as `universal_newlines` for one shot commands.
+            return output.decode(md_testsuite.encoding).replace('\r\n', '\n').replace('\r', '\n')
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+    def kill(self):
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        self.process.wait()
+
+def python_worker_main(engine_name):
+    """
+    Main loop of a `PythonWorker` process, see `python-engine-worker.py`.
+    """
+    output = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+    # Anything the engine prints must not be taken for a response.
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+    os.close(devnull)
+    # EOF on stdin only comes once the harness exited if the worker is idle, so also watch for it while rendering.
+    parent_pid = os.getppid()
+    def exit_with_parent():
+        while os.getppid() == parent_pid:
+            time.sleep(1)
+        os._exit(1)
+    watcher = threading.Thread(target=exit_with_parent)
+    watcher.daemon = True
+    watcher.start()
+    engine = getattr(Engines, engine_name)
+    module = engine.import_module()
+    for line in iter(sys.stdin.readline, ''):
+        try:
+            response = ('output', engine.render(module, json.loads(line)))
+        except MemoryError:
+            response = ('memory', '')
+        except Exception, e:
+            response = ('error', repr(e))
+        output.write(json.dumps(response) + '\n')
+        output.flush()
+
+class PythonWorker(object):
+    """
+    Process which renders many inputs with a `Engines.PythonEngine`, like `Worker` does with a command.
+
+    The process runs `python-engine-worker.py` with the limits of the config, and exits when the harness does.
+    """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'python-engine-worker.py')
+    def __init__(self, engine_name):
+        self.process = subprocess.Popen(
+            [sys.executable, self.script, engine_name],
+            shell  = False,
+            stdin  = subprocess.PIPE,
+            stdout = subprocess.PIPE,
+            close_fds = True,
+            # CPU time accumulates over all inputs, so only the timeout applies to each of them.
+            preexec_fn = lambda: set_command_limits(cpu=False)
+        )
+    def get_output(self, input):
+        try:
+            with phase('write'):
+                self.process.stdin.write(json.dumps(input) + '\n')
+                self.process.stdin.flush()
+        except IOError:
+            raise WorkerError('Worker exited.')
+        timer = start_kill_timer(self.process)
+        try:
+            with phase('engine'):
+                line = self.process.stdout.readline()
+        finally:
+            if timer is not None:
+                timer.cancel()
+                timer.join()
+        if not line:
+            if timer is not None and timer.fired:
+                raise EngineTimeout('Worker exceeded the time limit.')
+            raise WorkerError('Worker exited.')
+        with phase('decode'):
+            status, value = json.loads(line)
+        if status == 'memory':
+            raise EngineMemoryError('Worker exceeded the memory limit.')
+        if status == 'error':
+            raise Exception(value)
+        return value
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+    def kill(self):
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        self.process.wait()
+
+class WorkerPool(object):
+    """
+    Idle workers of a single command.
+
+    A new worker is started whenever all existing ones are busy,
+    so there are at most as many workers as parallel jobs.
+
+    `worker_class` is called with `command` to start a worker, e.g. `PythonWorker` with an engine name.
+    """
+    def __init__(self, command, worker_class=Worker):
+        self.command = command
+        self.worker_class = worker_class
+        self.idle = Queue.Queue()
+        self.workers = []
+    def get_output(self, input):
+        try:
+            worker = self.idle.get_nowait()
+        except Queue.Empty:
+            try:
+                with phase('spawn'):
+                    worker = self.worker_class(self.command)
+            except OSError:
+                raise WorkerError('Worker could not be started.')
+            count('spawns')
+            self.workers.append(worker)
+        try:
+            output = worker.get_output(input)
+        except (WorkerError, EngineTimeout):
+            self.workers.remove(worker)
+            worker.kill()
+            raise
+        except Exception:
+            # The worker is still usable after an error of the engine on this input.
+            self.idle.put(worker)
+            raise
+        self.idle.put(worker)
+        return output
+    def close(self):
+        for worker in self.workers:
+            worker.close()
+
+class HTTPError(Exception):
+    pass
+
+class HTTPConnectionPool(object):
+    """
+    Keep alive connections to a single URL, shared by all threads.
+
+    At most `size` requests are made at once. Failed requests are retried with exponential backoff,
+    and all requests wait while the `X-RateLimit-*` or `Retry-After` response headers
+    say that the rate limit is exhausted.
+
+    Connections time out after `timeout` seconds, `config['timeout']` by default.
+    """
+    def __init__(self, url, size, retries, max_wait, timeout=None):
+        url = urlparse.urlsplit(url)
+        if url.scheme == 'https':
+            self.connection_class = httplib.HTTPSConnection
+        else:
+            self.connection_class = httplib.HTTPConnection
+        self.host = url.netloc
+        self.path = url.path
+        if url.query:
+            self.path += '?' + url.query
+        self.retries = retries
+        self.max_wait = max_wait
+        self.timeout = config['timeout'] if timeout is None else timeout
+        self.idle = Queue.Queue()
+        self.semaphore = threading.BoundedSemaphore(size)
+        self.lock = threading.Lock()
+        self.resume_time = 0
+    def wait_rate_limit(self):
+        with self.lock:
+            delay = self.resume_time - time.time()
+        if delay > self.max_wait:
+            raise HTTPError('Rate limit exceeded for {:.0f}s.'.format(delay))
+        if delay > 0:
+            time.sleep(delay)
+    def update_rate_limit(self, response):
+        """
+        Return True if the response says that the rate limit was exceeded.
+        """
+        resume_time = None
+        retry_after = response.getheader('Retry-After')
+        reset = response.getheader('X-RateLimit-Reset')
+        if retry_after is not None and retry_after.isdigit():
+            resume_time = time.time() + int(retry_after)
+        elif response.getheader('X-RateLimit-Remaining') == '0' and reset is not None and reset.isdigit():
+            resume_time = int(reset)
+        if resume_time is not None:
+            with self.lock:
+                self.resume_time = max(self.resume_time, resume_time)
+        return resume_time is not None and response.status in (403, 429)
+    def request(self, method, body, headers):
+        """
+        Returns a 2-tuple `(status, response_body)`.
+        """
+        with self.semaphore:
+            for attempt in xrange(self.retries + 1):
+                if attempt:
+                    time.sleep(0.5 * 2 ** (attempt - 1))
+                self.wait_rate_limit()
+                try:
+                    connection = self.idle.get_nowait()
+                except Queue.Empty:
+                    connection = self.connection_class(self.host, timeout=self.timeout)
+                try:
+                    connection.request(method, self.path, body, headers)
+                    response = connection.getresponse()
+                    response_body = response.read()
+                except (httplib.HTTPException, socket.error), e:
+                    connection.close()
+                    error = str(e) or e.__class__.__name__
+                    continue
+                if response.getheader('Connection', '').lower() == 'close':
+                    connection.close()
+                else:
+                    self.idle.put(connection)
+                if self.update_rate_limit(response):
+                    error = 'Rate limit exceeded.'
+                    continue
+                if response.status >= 500:
+                    error = 'HTTP status {}'.format(response.status)
+                    continue
+                return response.status, response_body
+            raise HTTPError(error)
 
 class Engine(object):
     @classmethod
+    def fingerprint(cls):
+        """
+        String that changes whenever the engine version might have changed, used as output cache key.
+
+        Engines whose version cannot be determined only change fingerprint with their name.
+        """
+        return cls.__name__
+    @classmethod
+    def cacheable(cls, output):
+        """Outputs for which this returns false are not cached, e.g. because they are transient errors."""
+        return True
+    @classmethod
     def available(cls):
         try:
             stdin_stdout_get_output(cls.command, '')
@@ -178,6 +988,26 @@ class Engine(object):
             return False
         else:
             return True
+    @classmethod
+    def probe_key(cls):
+        """
+        String which, if unchanged, means that the result of `available` and `version` are unchanged,
+        so that they can be stored across runs by `probe_engines`. `None` if they cannot be stored.
+
+        If `probe_store_unavailable` is false, only results where the engine is available are stored.
+        """
+        return None
+    probe_store_unavailable = True
+    @classmethod
+    def version(cls):
+        return ''
+    @classmethod
+    def start_workers(cls):
+        """Use long lived processes for the following `get_output` calls if the engine supports it."""
+        pass
+    @classmethod
+    def stop_workers(cls):
+        pass
 
 class Engines(object):
     """
@@ -189,37 +1019,255 @@ class Engines(object):
     The names of those classes must correspond exactly to directory names under `extensions/`.
     """
 
-    class gfm(Engine):
+    class HTTPEngine(Engine):
         """
-        You **must** be authenticated to use this because this test suite has more than 50 tests.
-        <http://developer.github.com/v3/#rate-limiting>
-        - authenticated: 60 requests per hour
-        - unauthenticated requests: 5000 requests per hour
+        Base class for engines which use a REST API at `url`.
+
+        Requests of all tests go through a single `HTTPConnectionPool`,
+        so they can be made in parallel with `--jobs` up to `config['http_connections']` at once.
+
+        Availability is probed with a single request of at most `probe_timeout` seconds, and only stored
+        while available since the network may come back.
         """
-        url = 'https://api.github.com/markdown?access_token=' + config['gfm_oauth_token']
+        connection_error = 'CONNEXION ERROR: '
+        probe_timeout = 2
+        probe_store_unavailable = False
+        @classmethod
+        def request(cls, body, headers={}):
+            if '_connection_pool' not in cls.__dict__:
+                cls._connection_pool = HTTPConnectionPool(cls.url, config['http_connections'],
+                        config['http_retries'], config['http_max_wait'])
+            return cls._connection_pool.request('POST', body, headers)
         @classmethod
         def get_output(cls, input):
-            data = '{{"text":{},"mode":"gfm","context":"github/gollum"}}'.format(json.dumps(input))
-            req = urllib2.Request(cls.url, data)
+            """
+            Connection errors and error statuses are returned as output prefixed by `connection_error`.
+            """
+            try:
+                with phase('http'):
+                    status, body = cls.request(cls.request_body(input), cls.request_headers())
+            except HTTPError, e:
+                return cls.connection_error + str(e)
+            if status != 200:
+                return cls.connection_error + 'HTTP status {}'.format(status)
+            count('output_bytes', len(body))
+            with phase('decode'):
+                return body.decode(md_testsuite.encoding)
+        @classmethod
+        def request_headers(cls):
+            return {}
+        @classmethod
+        def fingerprint(cls):
+            return cls.__name__ + ' ' + cls.url
+        @classmethod
+        def cacheable(cls, output):
+            return not output.startswith(cls.connection_error)
+        @classmethod
+        def probe_key(cls):
+            # Header names tell if a token is set without storing it.
+            return '\0'.join([cls.__name__, cls.url] + sorted(cls.request_headers()))
+        @classmethod
+        def available(cls):
+            pool = HTTPConnectionPool(cls.url, 1, 0, 0, cls.probe_timeout)
             try:
-                response = urllib2.urlopen(req, timeout = config['timeout'])
-            except urllib2.URLError, e:
-                return 'CONNEXION ERROR: ' + str(e)
-            return response.read().decode(md_testsuite.encoding)
+                status, body = pool.request('POST', cls.request_body(u''), cls.request_headers())
+            except HTTPError:
+                return False
+            return status == 200
+
+    class gfm(HTTPEngine):
+        """
+        You **must** be authenticated to use this because this test suite has more than 50 tests.
+        <http://developer.github.com/v3/#rate-limiting>
+        - unauthenticated: 60 requests per hour
+        - authenticated requests: 5000 requests per hour
+
+        Set `gfm_url` to use a local stand-in server such as `http-engine-server.py` instead.
+        """
+        url = config['gfm_url']
+        @classmethod
+        def request_body(cls, input):
+            return json.dumps({"text": input, "mode": "gfm", "context": "github/gollum"})
+        @classmethod
+        def request_headers(cls):
+            headers = {'Content-Type': 'application/json'}
+            if config['gfm_oauth_token']:
+                headers['Authorization'] = 'token ' + config['gfm_oauth_token']
+            return headers
 
     class CommandEngine(Engine):
         """
         Base class for engines which use a command in PATH.
+
+        Engines may also set `worker_command` to a command that follows the `Worker` protocol.
+        It is used instead of `command` after `start_workers`.
+
+        Engines whose version is not that of the executable of `command`, e.g. a library run by an interpreter,
+        set `version_command` and override `fingerprint_files` so that cached outputs change with it.
         """
+        worker_command = None
+        worker_pool = None
+        version_command = None
+        @classmethod
+        def fingerprint_files(cls):
+            """
+            Paths of the files used by the engine: the arguments of `command` and `worker_command`
+            which are either an executable in `PATH` or a script relative to the current directory.
+            """
+            paths = []
+            for arg in cls.command + (cls.worker_command or []):
+                path = distutils.spawn.find_executable(arg) or arg
+                if os.path.isfile(path) and path not in paths:
+                    paths.append(path)
+            return paths
+        @classmethod
+        def files_fingerprint(cls):
+            """
+            Path, modification time and size of each file of `fingerprint_files`.
+            """
+            if '_files_fingerprint' not in cls.__dict__:
+                parts = [cls.__name__]
+                for path in cls.fingerprint_files():
+                    if os.path.isfile(path):
+                        stat = os.stat(path)
+                        parts.append('{}:{}:{}'.format(os.path.realpath(path), stat.st_mtime, stat.st_size))
+                cls._files_fingerprint = ' '.join(parts)
+            return cls._files_fingerprint
+        @classmethod
+        def fingerprint(cls):
+            return cls.files_fingerprint() + ' ' + cls.version()
+        @classmethod
+        def probe_key(cls):
+            return os.environ.get('PATH', '') + '\0' + cls.files_fingerprint()
+        @classmethod
+        def version(cls):
+            """
+            First line of the output of `version_command`, by default the executable of the command with `--version`,
+            or empty if that fails.
+            """
+            if '_version' not in cls.__dict__:
+                try:
+                    output = stdin_stdout_get_output(cls.version_command or [cls.command[0], '--version'], '')
+                except Exception:
+                    output = ''
+                cls._version = output.strip().split('\n')[0]
+            return cls._version
         @classmethod
         def get_output(cls, input):
+            if cls.worker_pool is not None:
+                try:
+                    return cls.worker_pool.get_output(input)
+                except WorkerError:
+                    # Fall back to one shot mode for this input.
+                    pass
             return stdin_stdout_get_output(cls.command, input)
+        @classmethod
+        def start_workers(cls):
+            if cls.worker_command is not None:
+                cls.worker_pool = WorkerPool(cls.worker_command)
+        @classmethod
+        def stop_workers(cls):
+            if cls.worker_pool is not None:
+                cls.worker_pool.close()
+                cls.worker_pool = None
+
+    class PythonEngine(CommandEngine):
+        """
+        Base class for engines implemented by a Python module, which is imported once
+        in long lived `PythonWorker`s instead of running `command` for each input.
+
+        Subclasses set `module` to the name of the module, and implement `render(module, input)`.
+        If the module cannot be imported, the engine falls back to `command` like a `CommandEngine`.
+
+        Workers are started on first use even without `start_workers`, render in parallel with `--jobs`,
+        and are subject to the limits of the config. The harness only imports the module for its version.
+        """
+        module = None
+        worker_lock = threading.Lock()
+        @classmethod
+        def import_module(cls):
+            """
+            The imported module, or `None` if it cannot be imported.
+            """
+            if '_module' not in cls.__dict__:
+                try:
+                    cls._module = importlib.import_module(cls.module)
+                except Exception:
+                    cls._module = None
+            return cls._module
+        @classmethod
+        def module_path(cls):
+            """
+            Path of the module without importing it, or empty if it is not found.
+            """
+            try:
+                module_file, path, description = imp.find_module(cls.module.split('.')[0])
+            except ImportError:
+                return ''
+            if module_file is not None:
+                module_file.close()
+            return path
+        @classmethod
+        def render(cls, module, input):
+            raise NotImplementedError
+        @classmethod
+        def fingerprint(cls):
+            module = cls.import_module()
+            if module is None:
+                return super(Engines.PythonEngine, cls).fingerprint()
+            path = os.path.realpath(getattr(module, '__file__', ''))
+            stat = os.stat(path)
+            return '{} {}:{}:{} {}'.format(cls.__name__, path, stat.st_mtime, stat.st_size, cls.version())
+        @classmethod
+        def probe_key(cls):
+            return super(Engines.PythonEngine, cls).probe_key() + '\0' + sys.executable + '\0' + cls.module_path()
+        @classmethod
+        def available(cls):
+            return cls.import_module() is not None or super(Engines.PythonEngine, cls).available()
+        @classmethod
+        def version(cls):
+            """
+            `__version__` of the module, or the version of the command if the module cannot be imported.
+            """
+            module = cls.import_module()
+            if module is None:
+                return super(Engines.PythonEngine, cls).version()
+            return 'python {}'.format(getattr(module, '__version__', ''))
+        @classmethod
+        def get_output(cls, input):
+            if cls.import_module() is None:
+                return super(Engines.PythonEngine, cls).get_output(input)
+            with cls.worker_lock:
+                if cls.worker_pool is None:
+                    cls.start_workers()
+            try:
+                return cls.worker_pool.get_output(input)
+            except WorkerError:
+                # Fall back to a new worker for this input only, like one shot commands.
+                with phase('spawn'):
+                    worker = PythonWorker(cls.__name__)
+                count('spawns')
+                try:
+                    return worker.get_output(input)
+                finally:
+                    worker.kill()
+        @classmethod
+        def start_workers(cls):
+            if cls.import_module() is None:
+                super(Engines.PythonEngine, cls).start_workers()
+            else:
+                cls.worker_pool = WorkerPool(cls.__name__, PythonWorker)
 
     class blackfriday(CommandEngine): command = ['blackfriday-tool']
     class hoedown(CommandEngine): command = ['hoedown']
     class kramdown(CommandEngine): command = ['kramdown']
     class lunamark(CommandEngine): command = ['lunamark']
-    class markdown2(CommandEngine): command = ['markdown2']
+    class markdown2(PythonEngine):
+        command = ['markdown2']
+        module = 'markdown2'
+        @classmethod
+        def render(cls, module, input):
+            return unicode(module.markdown(input))
     class markdown_pl(CommandEngine): command = ['Markdown.pl']
     class marked(CommandEngine): command = ['marked']
     class maruku(CommandEngine): command = ['maruku']
@@ -227,86 +1275,963 @@ class Engines(object):
     class multimarkdown(CommandEngine): command = ['multimarkdown', '-c']
     class pandoc(CommandEngine):        command = ['pandoc']
     class peg_markdown(CommandEngine): command = ['peg-markdown']
+    class python_markdown(PythonEngine):
+        command = ['markdown_py']
+        module = 'markdown'
+        @classmethod
+        def render(cls, module, input):
+            return module.markdown(input)
     class rdiscount(CommandEngine): command = ['rdiscount']
     class redcarpet(CommandEngine):     command = ['redcarpet']
-    class showdown(CommandEngine):      command = ['node', 'showdown-stdin.js']
+    class showdown(CommandEngine):
+        command = ['node', 'showdown-stdin.js']
+        worker_command = ['node', 'showdown-batch.js']
+        version_command = ['node', '-p', "process.version + ' showdown ' + require('showdown/package.json').version"]
+        @classmethod
+        def fingerprint_files(cls):
+            """
+            Also the `package.json` of the showdown module, which changes when it is upgraded.
+            """
+            paths = super(Engines.showdown, cls).fingerprint_files()
+            try:
+                paths.append(stdin_stdout_get_output(['node', '-p', "require.resolve('showdown/package.json')"],
+                        '').strip())
+            except Exception:
+                pass
+            return paths
+
+class TestOutcome(object):
+    """
+    Outcome of a test of an engine.
+
+    The detail of a failure is only rendered when `detail` is first read, e.g. when the failure is printed,
+    from the raw output of the engine which is then dropped.
+
+    `engine_time` is the time the engine took to produce the output, also when it came from the cache.
+    """
+    __slots__ = ('case', 'engine_name', 'number', 'marker', 'elapsed_time', 'peak_memory', 'engine_time',
+            'replayed', 'output', 'error', '_detail')
+
+    def __init__(self, case, engine_name, number, marker, elapsed_time, peak_memory, engine_time=None,
+            output=None, error=None, detail=None, replayed=False):
+        """
+        Exactly one of `output` for tests which got an output, `error` for `EngineLimitError`s,
+        or `detail` for results merged from shards is given.
+        """
+        self.case = case
+        self.engine_name = engine_name
+        self.number = number
+        self.marker = marker
+        self.elapsed_time = elapsed_time
+        self.peak_memory = peak_memory
+        self.engine_time = engine_time
+        self.replayed = replayed
+        self.output = output
+        self.error = error
+        self._detail = detail
+
+    @property
+    def detail(self):
+        """
+        Description of the failure, empty if the test passed.
+        """
+        if self._detail is None:
+            if self.marker == '.':
+                self._detail = ''
+            elif self.error is not None:
+                self._detail = repr(self.case.input) + '\n' + '\n' + self.error + '\n' + '\n'
+            else:
+                self._detail = failure_detail(self.case.input, self.output, self.case.output,
+                        self.case.normalized_output(output_index))
+            self.output = None
+        return self._detail
+
+    def format(self):
+        return (
+            '# ' + self.case.name + ' | #' + unicode(self.number) + ' | ' + self.engine_name + '\n'
+            + "=" * 70 + '\n'
+            + '\n'
+            + self.detail
+            + format_time_and_memory(self.elapsed_time, self.peak_memory) + '\n'
+            + '\n'
+        )
 
 class TestResult(object):
     """
     Encapsulates test results for one engine.
+
+    Error IOs are kept as a list of the `TestOutcome` of failed tests, and summaries as a list of strings,
+    both only rendered and joined when read, so that adding many results stays linear.
+
+    `peak_memories` is a list of `(peak_memory, engine_name, path)` of the tests that ran a command.
     """
-    def __init__(self, error_io_string="", summary_one_line=""):
-        self.error_io_string = error_io_string
-        self.summary_one_line = summary_one_line
+    def __init__(self, error_ios=None, summaries=None, peak_memories=None):
+        self.error_ios = error_ios or []
+        self.summaries = summaries or []
+        self.peak_memories = peak_memories or []
+
+    @property
+    def error_io_string(self):
+        return "".join(outcome.format() for outcome in self.error_ios)
+
+    @property
+    def summary_one_line(self):
+        return "".join(self.summaries)
 
     def __add__(self, other):
         return TestResult(
-            self.error_io_string + other.error_io_string,
-            self.summary_one_line + other.summary_one_line,
+            self.error_ios + other.error_ios,
+            self.summaries + other.summaries,
+            self.peak_memories + other.peak_memories,
         )
 
-def stdout_and_string(old, new):
+    def __iadd__(self, other):
+        self.error_ios.extend(other.error_ios)
+        self.summaries.extend(other.summaries)
+        self.peak_memories.extend(other.peak_memories)
+        return self
+
+def format_time_and_memory(elapsed_time, peak_memory):
+    """
+        >>> format_time_and_memory(1.5, 3 * 2**20)
+        'Time: 1.50s Peak memory: 3.0MB'
+    """
+    output = 'Time: {:.2f}s'.format(elapsed_time)
+    if peak_memory is not None:
+        output += ' Peak memory: {:.1f}MB'.format(peak_memory / float(2**20))
+    return output
+
+def format_peak_memories(test_results, number):
+    """
+    Lines of the `number` tests with highest peak memory across the given `TestResult`s.
     """
-    Add new string to old string, print it to stdout and flush.
+    peak_memories = sorted(itertools.chain(*(r.peak_memories for r in test_results)), reverse=True)
+    return ''.join('{:>8.1f}MB {} {}\n'.format(peak_memory / float(2**20), engine_name, path)
+            for peak_memory, engine_name, path in peak_memories[:number])
 
-    Returns new concatanted string.
+def stdout_and_append(parts, new):
+    """
+    Append new string to a list of strings, print it to stdout and flush.
     """
     sys.stdout.write(new)
     sys.stdout.flush()
-    return old + new
+    parts.append(new)
+
+class JSONLinesWriter(object):
+    """
+    Write one JSON object per test result as soon as it is known.
+    """
+    def __init__(self, path):
+        self.file = open(path, 'w')
+    def write(self, record):
+        self.file.write(json.dumps(record, sort_keys=True) + '\n')
+        self.file.flush()
+    def close(self):
+        self.file.close()
+
+class JUnitWriter(object):
+    """
+    Write test results as JUnit XML as soon as they are known,
+    with one `testsuite` for each engine and suite.
+
+    Test suites have no counts since they are written before their tests run.
+    """
+    def __init__(self, path):
+        self.file = open(path, 'w')
+        self.file.write('<?xml version="1.0" encoding="{}"?>\n<testsuites>\n'.format(md_testsuite.encoding))
+        self.testsuite = None
+    def write(self, record):
+        testsuite = record['engine'] + '.' + record['suite']
+        if testsuite != self.testsuite:
+            if self.testsuite is not None:
+                self.file.write('</testsuite>\n')
+            self.file.write('<testsuite name={}>\n'.format(quoteattr(testsuite)))
+            self.testsuite = testsuite
+        self.file.write('<testcase classname={} name={} time="{:.6f}"'.format(
+                quoteattr(testsuite), quoteattr(record['path']), record['time']))
+        if record['status'] == 'pass':
+            self.file.write('/>\n')
+        else:
+            tag = 'failure' if record['status'] == 'fail' else 'error'
+            self.file.write('>\n<{0} type={1}>{2}</{0}>\n</testcase>\n'.format(
+                    tag, quoteattr(record['status']), escape(record['detail']).encode(md_testsuite.encoding)))
+        self.file.flush()
+    def close(self):
+        if self.testsuite is not None:
+            self.file.write('</testsuite>\n')
+        self.file.write('</testsuites>\n')
+        self.file.close()
+
+# Status of the records of `result_writers` by progress marker.
+marker_statuses = {'.': 'pass', 'F': 'fail', 'T': 'timeout', 'M': 'memory'}
+
+def get_output_timed(engine_name, input, cache=True):
+    """
+    Get the output of an engine, and the wall time it took to get it.
+
+    Outputs are taken from `output_cache` when possible, unless `cache` is false.
+
+    Returns a 4-tuple `(output, elapsed_time, peak_memory, engine_time)`,
+    where `peak_memory` is `None` unless a command was run for this input,
+    and `engine_time` is the time the engine took, stored with cached outputs, `None` if unknown.
+
+    `EngineLimitError`s are raised with their `elapsed_time`, `peak_memory` and `engine_time` set.
+    """
+    start_time = time.time()
+    command_stats.peak_memory = None
+    engine = getattr(Engines, engine_name)
+    cached = None
+    cache = cache and output_cache is not None
+    if cache:
+        with phase('cache'):
+            cached = output_cache.get(engine_name, engine.fingerprint(), input)
+        count('cache_hits' if cached is not None else 'cache_misses')
+    if cached is not None:
+        output, engine_time = cached
+    else:
+        try:
+            output = engine.get_output(input)
+        except EngineLimitError, e:
+            e.elapsed_time = e.engine_time = time.time() - start_time
+            e.peak_memory = command_stats.peak_memory
+            raise
+        engine_time = time.time() - start_time
+        if cache and engine.cacheable(output):
+            with phase('cache'):
+                output_cache.put(engine_name, engine.fingerprint(), input, output, engine_time)
+    return output, time.time() - start_time, command_stats.peak_memory, engine_time
+
+def result_fingerprint(engine_name, input, expected_output):
+    """
+    Changes whenever the result of a test might change:
+    when its input or expected output, the engine, or the normalization change.
+    """
+    fingerprint = hashlib.sha1()
+    for part in (input, expected_output, getattr(Engines, engine_name).fingerprint(), normalizer_version()):
+        fingerprint.update(part.encode(md_testsuite.encoding))
+        fingerprint.update('\0')
+    return fingerprint.hexdigest()
+
+def test_category(path):
+    """
+    Category of a test for `--sample`: the first word of its name, with any leading number,
+    under the directory of tests from other sources.
+
+        >>> test_category(u'link-idref-title')
+        u'link'
+        >>> test_category(u'2-paragraphs-line')
+        u'2-paragraphs'
+        >>> test_category(u'markdown-spec/headings-1')
+        u'markdown-spec/headings'
+    """
+    directory, slash, name = path.rpartition(u'/')
+    words = name.split(u'-')
+    i = 0
+    while i < len(words) - 1 and words[i].isdigit():
+        i += 1
+    return directory + slash + u'-'.join(words[:i + 1])
+
+def sample_tests(cases, n, seed=0):
+    """
+    Return `n` of the given `md_testsuite.TestCase` spread evenly over their `test_category`, in their original order.
+
+    Categories are picked from in turn, so each of them has a test if `n` is large enough.
+    The sample only depends on the names of the tests and on `seed`, so it is the same for all engines.
+
+        >>> cases = [md_testsuite.TestCase(name, None, None) for name in [u'a-1', u'a-2', u'a-3', u'a-4', u'b-1', u'c-1']]
+        >>> sorted(test_category(case.name) for case in sample_tests(cases, 3))
+        [u'a', u'b', u'c']
+        >>> len(sample_tests(cases, 4))
+        4
+    """
+    if n >= len(cases):
+        return cases
+    rng = random.Random(seed)
+    categories = collections.OrderedDict()
+    for i, case in enumerate(cases):
+        categories.setdefault(test_category(case.name), []).append(i)
+    groups = categories.values()
+    for group in groups:
+        rng.shuffle(group)
+    rng.shuffle(groups)
+    selected = []
+    while len(selected) < n:
+        for group in groups:
+            if group and len(selected) < n:
+                selected.append(group.pop())
+    return [cases[i] for i in sorted(selected)]
+
+def failing_first(cases, engine_name, suite):
+    """
+    Order tests whose last result in `result_store` was not a pass first, keeping the order otherwise.
+    """
+    def key(case):
+        stored = result_store.get(engine_name, suite, case.name)
+        return stored is None or stored.marker == '.'
+    return sorted(cases, key=key)
 
-def run_tests(io_iterator, engine_name, l, args):
+def parse_shard(string):
+    """
+    Parse the `i/N` argument of `--shard` into a 2-tuple `(i, N)`.
+
+        >>> parse_shard('2/3')
+        (2, 3)
+    """
+    try:
+        shard, shards = map(int, string.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError("must be of the form i/N, e.g. 1/4")
+    if not 1 <= shard <= shards:
+        raise argparse.ArgumentTypeError("i must be between 1 and N")
+    return shard, shards
+
+def balance_shards(times, shards, offset=0):
+    """
+    Assign items of the given times to `shards` shards with total times as even as possible,
+    and return the shard index of each item, starting at 0.
+
+    Longest items are assigned first, each to the least loaded shard.
+    Ties go to the first shard starting from `offset`, so that short lists do not all start on the same shard.
+
+        >>> balance_shards([5, 1, 1, 3, 2], 2)
+        [0, 0, 1, 1, 1]
+        >>> balance_shards([1, 1], 3, offset=2)
+        [2, 0]
+    """
+    loads = [0] * shards
+    assignment = [None] * len(times)
+    for i in sorted(xrange(len(times)), key=lambda i: -times[i]):
+        shard = min(xrange(shards), key=lambda s: (loads[s], (s - offset) % shards))
+        assignment[i] = shard
+        loads[shard] += times[i]
+    return assignment
+
+def shard_tests(tests, engine_name, suite, shard):
+    """
+    Return the `(number, case)` of `tests` which belong to `shard`, a 2-tuple `(i, N)` of `parse_shard`.
+
+    Tests are balanced with `balance_shards` by their engine time in `shard_timings` or `result_store`,
+    which unlike their elapsed time is not that of the output cache,
+    and tests without one count for the mean time of the others.
+    Each shard computes the partition on its own, which is the same for all of them
+    as long as they have the same tests and timings.
+    """
+    i, shards = shard
+    if shard_timings is not None:
+        known = dict((path, time) for (engine, s, path), time in shard_timings.iteritems()
+                if engine == engine_name and s == suite)
+    elif result_store is not None:
+        known = result_store.engine_times(engine_name, suite)
+    else:
+        known = {}
+    known = dict((path, time) for path, time in known.iteritems() if time is not None)
+    default = sum(known.itervalues()) / len(known) if known else 1.0
+    # Sort by name so that the partition does not depend on the order of the tests, e.g. `--failing-first`.
+    tests = sorted(tests, key=lambda test: test[1].name)
+    offset = zlib.crc32((engine_name + '/' + suite).encode(md_testsuite.encoding)) % shards
+    assignment = balance_shards([known.get(case.name, default) for number, case in tests], shards, offset)
+    return sorted(test for test, s in zip(tests, assignment) if s == i - 1)
+
+def load_timings(paths):
+    """
+    Read engine times by `(engine, suite, path)` from the JSON lines written by `--jsonl`.
+    Later records override earlier ones, except those without an engine time.
+    """
+    timings = {}
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                record = json.loads(line)
+                if record.get('engine_time') is not None:
+                    timings[(record['engine'], record['suite'], record['path'])] = record['engine_time']
+    return timings
+
+def merge_results(paths, engine_order=()):
+    """
+    Combine the JSON lines written by the `--jsonl` of each `--shard` of a run
+    into a 3-tuple `(test_result, test_result_extension, problems)` like those of an unsharded run.
+
+    Engines are ordered as in `engine_order`, then by name.
+    `problems` lists the tests which are duplicated or missing across the shards.
+    """
+    records = collections.defaultdict(dict)
+    problems = []
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                record = json.loads(line)
+                tests = records[(record['engine'], record['suite'])]
+                if record['number'] in tests:
+                    problems.append(u"Duplicated: {} {} #{}".format(record['engine'], record['suite'],
+                            record['number']))
+                tests[record['number']] = record
+    statuses_markers = dict((status, marker) for marker, status in marker_statuses.iteritems())
+    engine_names = sorted(set(engine_name for engine_name, suite in records),
+            key=lambda e: (list(engine_order).index(e) if e in engine_order else len(engine_order), e))
+    l = max([len(engine_name) for engine_name in engine_names] or [0])
+    test_results = []
+    for suite in ('base', 'extensions'):
+        test_result = TestResult()
+        for engine_name in engine_names:
+            tests = records.get((engine_name, suite), {})
+            missing = [number for number in xrange(1, max(tests or [0]) + 1) if number not in tests]
+            if missing:
+                problems.append(u"Missing: {} {} {}".format(engine_name, suite,
+                        u" ".join(u"#{}".format(number) for number in missing)))
+            elapsed_time = 0
+            markers = []
+            for number in sorted(tests):
+                record = tests[number]
+                marker = statuses_markers.get(record['status'], record['status'])
+                elapsed_time += record['time']
+                markers.append(marker)
+                if record['peak_memory'] is not None:
+                    test_result.peak_memories.append((record['peak_memory'], engine_name, record['path']))
+                if marker != '.':
+                    test_result.error_ios.append(TestOutcome(md_testsuite.TestCase(record['path'], None, None),
+                            engine_name, number, marker, record['time'], record['peak_memory'],
+                            record.get('engine_time'), detail=record['detail'], replayed=record['replayed']))
+            total = len(markers)
+            errors = len(markers) - markers.count('.')
+            percent = int(errors/float(total)*100) if total else 0
+            test_result.summaries.append("{:<{l}} |{}| {:>6.2f}s {:4} {:4} {:>3}%\n".format(
+                    engine_name, "".join(markers), elapsed_time, total, errors, percent, l=l))
+        test_results.append(test_result)
+    return test_results[0], test_results[1], problems
+
+def schedule_tests(cases, engine_name, args, pool=None, suite='base', only=None):
+    """
+    Filter the tests of one engine given by args, and start getting the outputs of the selected ones.
+
+    With `args.sample`, only a `sample_tests` of the tests is kept,
+    and with `args.failing_first` tests are ordered by `failing_first`.
+    With `args.shard`, only the tests of that shard are kept, see `shard_tests`.
+    If `only` is given, only the tests whose name is in it are kept, after numbering.
+
+    If `pool` is given, outputs are computed on it in the background as soon as this is called,
+    so that tests of several engines can be scheduled at once.
+    Else, outputs are computed lazily as they are iterated.
+
+    With `args.incremental`, tests whose result in `result_store` has the current `result_fingerprint`
+    are not run again.
+
+    Returns a 4-tuple `(tests, results, suite, stop)` where:
+
+    - `tests` is the list of `(number, case)` of the given `md_testsuite.TestCase` whose name contains
+        `args.filter_string` and which have an expected output, numbered in run order before sharding
+    - `results` iterates over `(fingerprint, result)` for the tests selected by `args.number`, in order.
+        `result` is either the return value of `get_output_timed`, the `EngineLimitError` it raised,
+        or a `md_testsuite.StoredResult`. It is `None` for the outputs not computed yet when `stop` is set.
+    - `suite` identifies `tests` in `result_store`, e.g. `base` or `extensions`.
+    - `stop` is a `threading.Event` to set to skip the remaining outputs, e.g. on `args.max_failures`.
+    """
+    cases = [case for case in cases if args.filter_string in case.name and case.output is not None]
+    if args.sample:
+        cases = sample_tests(cases, args.sample, args.sample_seed)
+    if args.failing_first and result_store is not None:
+        cases = failing_first(cases, engine_name, suite)
+    tests = list(enumerate(cases, 1))
+    if only is not None:
+        tests = [test for test in tests if test[1].name in only]
+    if args.shard:
+        tests = shard_tests(tests, engine_name, suite, args.shard)
+    stop = threading.Event()
+    jobs = []
+    for number, case in tests:
+        if not args.number or number == args.number:
+            fingerprint = None
+            stored = None
+            if result_store is not None:
+                fingerprint = result_fingerprint(engine_name, case.input, case.output)
+                if args.incremental:
+                    stored = result_store.get(engine_name, suite, case.name)
+                    if stored is not None and stored.fingerprint != fingerprint:
+                        stored = None
+            jobs.append((case, fingerprint, stored))
+    def get_result(job):
+        case, fingerprint, stored = job
+        if stored is not None:
+            return fingerprint, stored
+        if stop.is_set():
+            return fingerprint, None
+        if profiler is not None:
+            profiler.start(engine_name, suite, case.name)
+        try:
+            return fingerprint, get_output_timed(engine_name, case.input)
+        except EngineLimitError, e:
+            return fingerprint, e
+        finally:
+            if profiler is not None:
+                profiler.stop()
+    if pool is None:
+        results = itertools.imap(get_result, jobs)
+    else:
+        results = pool.imap(get_result, jobs)
+    return tests, results, suite, stop
+
+def truncate_repr(string, limit=1000):
+    """
+        >>> truncate_repr(u"abcdef", 3)
+        "u'abc' ... 3 more characters"
+    """
+    if len(string) <= limit:
+        return repr(string)
+    return repr(string[:limit]) + ' ... {} more characters'.format(len(string) - limit)
+
+def check_output(output, normalized_expected_output):
+    """
+    Compare the output of an engine to the expected one, and return the progress character of the test.
+    """
+    if normalize_output(output) == normalized_expected_output:
+        return "."
+    return "F"
+
+def failure_detail(input, output, expected_output, normalized_expected_output):
+    """
+    Describe why `output` is not as expected.
+
+    Long inputs and outputs are truncated, and their `first_difference` is always included.
+    """
+    with phase('diff'):
+        actual_tokens = normalize_tokens(output)
+        return (
+            truncate_repr(input) + '\n'
+            + '\n'
+            + 'Normalized actual / expected:' + '\n'
+            + truncate_repr(u"".join(actual_tokens)) + '\n'
+            + truncate_repr(normalized_expected_output) + '\n'
+            + '\n'
+            + first_difference(actual_tokens, normalize_tokens(expected_output))
+            + '\n'
+            + 'Raw actual / expected:' + '\n'
+            + truncate_repr(output) + '\n'
+            + truncate_repr(expected_output) + '\n'
+            + '\n'
+        )
+
+def run_tests(scheduled_tests, engine_name, l, args):
     """
     Run tests for one engine for the given input output pairs.
 
-    Outputs progress bar while running the tests.
+    `scheduled_tests` is the return value of `schedule_tests`.
+
+    Outputs progress bar while running the tests, in test order
+    even if the outputs were computed in parallel.
+
+    Results of tests that ran are saved to `result_store`, and stored results are replayed as is,
+    including their time. Shards do not save results, so that they all balance tests with the same timings.
+
+    With `args.max_failures`, the remaining tests are skipped once that many tests failed.
 
     args are used to filter which tests will be run.
     """
     total = 0
     errors = 0
-    start_time = time.time()
-    error_io_string = ""
-    summary_one_line = ""
-    summary_one_line = stdout_and_string(summary_one_line, "{:<{l}} |".format(engine_name, l=l))
-    engine = getattr(Engines, engine_name)
-    io_iterator = itertools.ifilter(lambda io: args.filter_string in io[0], io_iterator)
-    for path, input, expected_output in io_iterator:
+    elapsed_time = 0
+    error_ios = []
+    peak_memories = []
+    summaries = []
+    stdout_and_append(summaries, "{:<{l}} |".format(engine_name, l=l))
+    tests, results, suite, stop = scheduled_tests
+    stopped = False
+    for number, case in tests:
+        if args.max_failures and errors >= args.max_failures:
+            stop.set()
+            stopped = True
+            break
         total += 1
-        if not args.number or total == args.number:
-            output = engine.get_output(input)
-            normalized_output = normalize_output(output)
-            normalized_expected_output = normalize_output(expected_output)
-            if normalized_output == normalized_expected_output:
-                summary_one_line = stdout_and_string(summary_one_line, ".")
+        if not args.number or number == args.number:
+            fingerprint, result = next(results)
+            if isinstance(result, md_testsuite.StoredResult):
+                outcome = TestOutcome(case, engine_name, number, result.marker, result.elapsed_time,
+                        result.peak_memory, result.engine_time, output=result.output, error=result.error,
+                        replayed=True)
             else:
+                if profiler is not None:
+                    profiler.start(engine_name, suite, case.name)
+                if isinstance(result, EngineLimitError):
+                    outcome = TestOutcome(case, engine_name, number, result.marker, result.elapsed_time,
+                            result.peak_memory, result.engine_time, error=str(result))
+                else:
+                    output, output_time, peak_memory, engine_time = result
+                    marker = check_output(output, case.normalized_output(output_index))
+                    outcome = TestOutcome(case, engine_name, number, marker, output_time, peak_memory, engine_time,
+                            output=output)
+                if result_store is not None and not args.shard:
+                    # The detail of failures is rendered again from the stored output when replayed.
+                    result_store.put(engine_name, suite, case.name, md_testsuite.StoredResult(fingerprint,
+                            outcome.marker, outcome.output if outcome.marker == 'F' else None, outcome.error,
+                            outcome.elapsed_time, outcome.peak_memory, outcome.engine_time))
+                if profiler is not None:
+                    profiler.stop()
+            elapsed_time += outcome.elapsed_time
+            if outcome.peak_memory is not None:
+                peak_memories.append((outcome.peak_memory, engine_name, case.name))
+            stdout_and_append(summaries, outcome.marker)
+            if outcome.marker != ".":
                 errors += 1
-                summary_one_line = stdout_and_string(summary_one_line, "F")
-                error_io_string += (
-                    '# ' + path + ' | #' + unicode(total) + ' | ' + engine_name + '\n'
-                    + "=" * 70 + '\n'
-                    + '\n'
-                    + repr(input) + '\n'
-                    + '\n'
-                    + 'Normalized actual / expected:' + '\n'
-                    + repr(normalized_output) + '\n'
-                    + repr(normalized_expected_output) + '\n'
-                    + '\n'
-                    + 'Raw actual / expected:' + '\n'
-                    + repr(output) + '\n'
-                    + repr(expected_output) + '\n'
-                    + '\n'
-                )
-    elapsed_time = time.time() - start_time
+                error_ios.append(outcome)
+            if result_writers:
+                record = {
+                    'engine': engine_name,
+                    'suite': suite,
+                    'path': case.name,
+                    'number': number,
+                    'status': marker_statuses.get(outcome.marker, outcome.marker),
+                    'time': outcome.elapsed_time,
+                    'peak_memory': outcome.peak_memory,
+                    'engine_time': outcome.engine_time,
+                    'replayed': outcome.replayed,
+                    'detail': outcome.detail,
+                }
+                if profiler is not None:
+                    record['phases'] = dict(profiler.tests.get((engine_name, suite, case.name), {}))
+                for writer in result_writers:
+                    writer.write(record)
+    if result_store is not None:
+        # Else the write lock of the store would be held while waiting, e.g. by `--watch`.
+        result_store.commit()
     if total == 0:
         percent = 0
     else:
         percent = int(errors/float(total)*100)
-    summary_one_line = stdout_and_string(
-        summary_one_line,
-        "| {:>6.2f}s {:4} {:4} {:>3}%\n".format(elapsed_time, total, errors, percent)
-    )
-    return TestResult(error_io_string, summary_one_line)
+    stdout_and_append(summaries, "| {:>6.2f}s {:4} {:4} {:>3}%{}\n".format(elapsed_time, total, errors, percent,
+            " stopped after {} failures".format(errors) if stopped else ""))
+    return TestResult(error_ios, summaries, peak_memories)
+
+def probe_engines(engine_names, store=True):
+    """
+    Return the sublist of the given engines that are available.
+
+    All engines are checked in parallel, and their `version` is also computed.
+    If `store`, results are stored under `cache_dir`, and reused while the `probe_key` of each engine is unchanged.
+    """
+    path = os.path.join(config['cache_dir'], 'engines.json')
+    stored = {}
+    if store:
+        try:
+            with open(path, 'r') as probe_file:
+                stored = json.load(probe_file)
+        except (IOError, ValueError):
+            pass
+    def probe(engine_name):
+        engine = getattr(Engines, engine_name)
+        key = engine.probe_key()
+        entry = stored.get(engine_name)
+        if key is not None and entry is not None and entry['key'] == key:
+            engine._version = entry['version']
+            return entry, False
+        return {'key': key, 'available': engine.available(), 'version': engine.version()}, True
+    if not engine_names:
+        return []
+    pool = ThreadPool(len(engine_names))
+    entries = pool.map(probe, engine_names)
+    pool.close()
+    changed = False
+    for engine_name, (entry, probed) in zip(engine_names, entries):
+        if probed and entry['key'] is not None and (entry['available']
+                or getattr(Engines, engine_name).probe_store_unavailable):
+            stored[engine_name] = entry
+            changed = True
+    if store and changed:
+        if not os.path.isdir(config['cache_dir']):
+            os.makedirs(config['cache_dir'])
+        with open(path, 'w') as probe_file:
+            json.dump(stored, probe_file, indent=2, sort_keys=True)
+    return [engine_name for engine_name, (entry, probed) in zip(engine_names, entries) if entry['available']]
+
+def percentile(sorted_values, p):
+    """
+    Nearest rank percentile of an already sorted list.
+
+        >>> percentile([1, 2, 3, 4], 50)
+        2
+        >>> percentile([1, 2, 3, 4], 99)
+        4
+    """
+    if not sorted_values:
+        return 0
+    return sorted_values[max(0, int(math.ceil(p / 100.0 * len(sorted_values))) - 1)]
+
+def bench_engine(engine_name, inputs, repeat):
+    """
+    Measure the conversion speed of one engine. Outputs are never taken from the cache.
+
+    Startup overhead is the median time to convert an empty input,
+    and is measured separately from the latencies of the given inputs.
+
+    Returns a dict of statistics in seconds and MB/s.
+    """
+    engine = getattr(Engines, engine_name)
+    startup_times = []
+    for i in xrange(repeat):
+        startup_times.append(get_output_timed(engine_name, u'', cache=False)[1])
+    latencies = []
+    for i in xrange(repeat):
+        for input in inputs:
+            latencies.append(get_output_timed(engine_name, input, cache=False)[1])
+    startup_times.sort()
+    total_time = sum(latencies)
+    size = sum(len(input.encode(md_testsuite.encoding)) for input in inputs) * repeat
+    latencies.sort()
+    return {
+        'fingerprint': engine.fingerprint(),
+        'inputs': len(inputs),
+        'repeat': repeat,
+        'bytes': size,
+        'startup': percentile(startup_times, 50),
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+        'total': total_time,
+        'throughput': size / float(2**20) / total_time if total_time else 0,
+    }
+
+def bench_engines(engine_names, args):
+    """
+    Print and return a dict of `bench_engine` statistics by engine name,
+    for the inputs of all tests selected by `args.filter_string` scaled by `args.bench_scale`.
+    """
+    l = len(max(engine_names, key=len))
+    print "{:<{l}} {:>9} {:>9} {:>9} {:>9} {:>9}".format(
+            "", "startup", "p50", "p95", "p99", "MB/s", l=l)
+    results = {}
+    for engine_name in engine_names:
+        ios = itertools.chain(md_testsuite.io_iterator(), md_testsuite.io_iterator_engine(engine_name))
+        inputs = [u'\n\n'.join([io[1]] * args.bench_scale) for io in ios if args.filter_string in io[0]]
+        result = bench_engine(engine_name, inputs, args.bench_repeat)
+        results[engine_name] = result
+        print "{:<{l}} {:>8.4f}s {:>8.4f}s {:>8.4f}s {:>8.4f}s {:>9.3f}".format(engine_name,
+                result['startup'], result['p50'], result['p95'], result['p99'], result['throughput'], l=l)
+    return results
+
+def scaling_exponent(sizes, times):
+    """
+    Least squares slope of log(time) over log(size):
+    about 1 for engines linear in the size of the input, 2 for quadratic ones.
+
+        >>> round(scaling_exponent([1, 2, 4], [3, 12, 48]), 6)
+        2.0
+    """
+    xs = [math.log(size) for size in sizes]
+    ys = [math.log(time) for time in times]
+    x_mean = sum(xs) / len(xs)
+    y_mean = sum(ys) / len(ys)
+    variance = sum((x - x_mean) ** 2 for x in xs)
+    if not variance:
+        return 0
+    return sum((x - x_mean) * (y - y_mean) for x, y in zip(xs, ys)) / variance
+
+def scale_engines(engine_names, args, multipliers=(1, 2, 4, 8, 16), repeat=3, superlinear_exponent=1.5):
+    """
+    Time engines on `md_generate` documents of increasing size, and flag those that scale superlinearly.
+
+    Each time is the minimum of `repeat` conversions minus the startup overhead,
+    and is fit against the size of the input in bytes, since that of some generators is not linear in their `n`,
+    e.g. the indentation of `md_generate.nested_lists`.
+    Only times well above the startup overhead are used to fit the `scaling_exponent`,
+    and if less than two remain it is not computed.
+    Outputs that do not match the expected ones are marked with `F`, and sizes for which the engine
+    fails with an error, or which are larger than one that failed, with `E`.
+
+    Returns a dict of results by engine and generator names.
+    """
+    ios = list(md_generate.io_iterator(multipliers))
+    l = max(len(name) for name in engine_names + md_generate.generators.keys())
+    print "{:<{l}} {} {:>9}".format("", " ".join("{:>9}".format("x" + str(m)) for m in multipliers),
+            "exponent", l=l)
+    results = {}
+    for engine_name in engine_names:
+        print engine_name
+        startup = min(get_output_timed(engine_name, u'', cache=False)[1] for i in xrange(repeat + 2))
+        min_time = max(startup * 0.2, 1e-3)
+        results[engine_name] = {}
+        for name, group in itertools.groupby(ios, lambda io: io[0].rsplit('-', 1)[0]):
+            ns = []
+            sizes = []
+            times = []
+            failed = False
+            error = False
+            for path, input, expected_output, n in group:
+                if error:
+                    # Larger sizes would likely fail too.
+                    continue
+                output_times = []
+                try:
+                    for i in xrange(repeat):
+                        output, output_time, peak_memory = get_output_timed(engine_name, input, cache=False)[:3]
+                        output_times.append(output_time)
+                except Exception:
+                    error = True
+                    continue
+                ns.append(n)
+                sizes.append(len(input.encode(md_testsuite.encoding)))
+                times.append(max(min(output_times) - startup, 0))
+                if normalize_output(output) != normalize_output(expected_output):
+                    failed = True
+            measured = [(size, time) for size, time in zip(sizes, times) if time >= min_time]
+            if len(measured) >= 2:
+                exponent = scaling_exponent(*zip(*measured))
+                exponent_string = "{:>9.2f}".format(exponent)
+            else:
+                exponent = None
+                exponent_string = "{:>9}".format("-")
+            results[engine_name][name] = {'ns': ns, 'sizes': sizes, 'times': times, 'exponent': exponent,
+                    'failed': failed, 'error': error}
+            time_strings = ["{:>8.4f}s".format(t) for t in times] + ["{:>9}".format("E")] * (len(multipliers) - len(times))
+            print "{:<{l}} {} {}{}{}".format(name, " ".join(time_strings), exponent_string,
+                    " superlinear" if exponent > superlinear_exponent else "", " F" if failed else "", l=l)
+    return results
+
+def differential_inputs(args):
+    """
+    List of `(path, input, expected_output)` of the Original markdown tests,
+    followed by the extension tests whose input was not seen before, with `None` as expected output
+    since it depends on the engine.
+    """
+    ios = []
+    seen = set()
+    for path, input, expected_output in md_testsuite.io_iterator():
+        ios.append((path, input, expected_output))
+        seen.add(input)
+    for path, input, expected_output in md_testsuite.io_iterator_all_engines():
+        if input not in seen:
+            ios.append((path, input, None))
+            seen.add(input)
+    return [io for io in ios if args.filter_string in io[0]]
+
+def differential(engine_names, args, pool=None):
+    """
+    Render all inputs with all given engines, and group engines which give the same normalized output.
+
+    Outputs are grouped by their hash, so each output is only normalized and hashed once per engine.
+    The expected output of Original markdown tests takes part as the pseudo engine `expected`.
+    Engines that fail on an input are grouped by their failure marker, e.g. `T`, or `E` for other errors.
+
+    Prints the classes of each input on which not all engines agree, followed by an agreement matrix:
+    the percentage of inputs for which each pair of engines is in the same class.
+
+    Returns a list of `(path, classes)`, where `classes` is a list of lists of engine names.
+    """
+    ios = differential_inputs(args)
+    def get_class_key(job):
+        engine_name, input = job
+        try:
+            output = get_output_timed(engine_name, input)[0]
+        except EngineLimitError, e:
+            return e.marker
+        except Exception:
+            return 'E'
+        return hashlib.sha1(normalize_output(output).encode(md_testsuite.encoding)).hexdigest()
+    jobs = [(engine_name, io[1]) for io in ios for engine_name in engine_names]
+    if pool is None:
+        keys = itertools.imap(get_class_key, jobs)
+    else:
+        keys = pool.imap(get_class_key, jobs)
+    member_names = engine_names + ['expected']
+    agreements = dict(((a, b), 0) for a in member_names for b in member_names)
+    totals = dict(((a, b), 0) for a in member_names for b in member_names)
+    all_classes = []
+    disagreements = 0
+    for path, input, expected_output in ios:
+        classes = collections.OrderedDict()
+        for engine_name in engine_names:
+            classes.setdefault(next(keys), []).append(engine_name)
+        members = list(engine_names)
+        if expected_output is not None:
+            key = hashlib.sha1(normalize_output(expected_output).encode(md_testsuite.encoding)).hexdigest()
+            classes.setdefault(key, []).append('expected')
+            members.append('expected')
+        for a in members:
+            for b in members:
+                totals[a, b] += 1
+        for names in classes.values():
+            for a in names:
+                for b in names:
+                    agreements[a, b] += 1
+        all_classes.append((path, classes.values()))
+        if len(classes) > 1:
+            disagreements += 1
+            print "{}: {}".format(path, " ".join("{" + " ".join(names) + "}" for names in classes.values()))
+    print "\n{} of {} inputs have different outputs across engines.\n".format(disagreements, len(ios))
+    l = max(len(name) for name in member_names)
+    print "{:<{l}} {}".format("", " ".join("{:>5}".format(name[:5]) for name in member_names), l=l)
+    for a in member_names:
+        print "{:<{l}} {}".format(a, " ".join(
+                "{:>4}%".format(int(100 * agreements[a, b] / totals[a, b])) if totals[a, b] else "    -"
+                for b in member_names), l=l)
+    return all_classes
+
+def corpus_test_keys(corpus):
+    """
+    Dict of the keys of the tests of a `md_testsuite.Corpus` by `(engine, name)`, with `engine` `None` for base tests.
+    """
+    keys = dict(((None, case.name), case.key) for case in corpus.tests)
+    for engine_name, cases in corpus.engine_tests.iteritems():
+        keys.update(((engine_name, case.name), case.key) for case in cases)
+    return keys
+
+def watch_tests(engine_names, args, pool=None, settle_time=0.05):
+    """
+    Wait for changes of the files of the tests, and run the tests of `engine_names` they affect again, until interrupted.
+
+    A test is affected if it is new, or if its input or expected output file changed,
+    including the base files that engine tests fall back to and the targets of symlinks, and runs once both files exist. Workers, caches and the corpus of the first run are kept,
+    and only the scanned tree and the changed files are read again.
+
+    Changes are taken together until none happened for `settle_time` seconds, as editors often write a file in steps.
+    """
+    corpus = md_testsuite.get_corpus()
+    watcher = md_testsuite.watcher(corpus.test_dir)
+    l = len(max(engine_names, key=len))
+    print "\nWatching {} with {}. Interrupt to stop.".format(corpus.test_dir, type(watcher).__name__)
+    try:
+        while True:
+            changed = watcher.changes()
+            more = changed
+            while more:
+                more = watcher.changes(settle_time)
+                changed |= more
+            start_time = time.time()
+            before = corpus_test_keys(corpus)
+            # Test files are often symlinks, e.g. engine outputs to variants under `extensions/`,
+            # and changes are reported for their targets.
+            changed_targets = set(os.path.realpath(path) for path in changed)
+            def is_changed(path):
+                return os.path.realpath(path) in changed_targets
+            stale = set(changed)
+            for key in before.itervalues():
+                stale.update(path for path in key if is_changed(path))
+            corpus.rescan(stale)
+            output_index.forget(stale)
+            after = corpus_test_keys(corpus)
+            affected = collections.defaultdict(set)
+            for (engine, name), key in after.iteritems():
+                # Files may be missing for a while, e.g. the output of a new test not written yet.
+                if (before.get((engine, name)) != key or any(is_changed(path) for path in key)) \
+                        and all(os.path.isfile(path) for path in key):
+                    affected[engine].add(name)
+            if not affected:
+                continue
+            print
+            test_result = TestResult()
+            test_result_extension = TestResult()
+            for engine_name in engine_names:
+                if affected[None]:
+                    test_result += run_tests(schedule_tests(md_testsuite.test_cases(), engine_name, args, pool,
+                            only=affected[None]), engine_name, l, args)
+            if any(affected[engine_name] for engine_name in engine_names):
+                print "\nExtensions:\n"
+                for engine_name in engine_names:
+                    if affected[engine_name]:
+                        test_result_extension += run_tests(schedule_tests(md_testsuite.test_cases_engine(engine_name),
+                                engine_name, args, pool, 'extensions', only=affected[engine_name]), engine_name, l, args)
+            if args.engine or args.filter_string:
+                sys.stdout.write(test_result.error_io_string + test_result_extension.error_io_string)
+            print "\nRan the tests affected by {} changed files in {:.2f}s.".format(len(changed),
+                    time.time() - start_time)
+    except KeyboardInterrupt:
+        print
 
 def format_error_ios_and_summaries(test_result, test_result_extension):
     return (
@@ -359,9 +2284,11 @@ Where:
 
 - `.` indicates a passing test
 - `F` indicates a failing test
-- `0.60s` is the wall time used to run all commands
+- `T` indicates a test for which the engine exceeded the time limit
+- `M` indicates a test for which the engine exceeded the memory limit
+- `0.60s` is the wall time used to run all commands, summed over the commands
 - `4` is the total number of tests
-- `1` is the total number of failing tests
+- `1` is the total number of failing tests, including `T` and `M`
 - `25%` is the percentage of failing tests
 
 Run all tests for the given engine:
@@ -372,6 +2299,61 @@ Run only tests which contain a literal string in the name:
 
     {f} -s string
     {f} -s string multimarkdown
+
+Run the commands of all engines on 4 parallel jobs:
+
+    {f} -j 4
+
+Reuse a single process per engine and job for engines that support it:
+
+    {f} -w
+
+Measure engine speed on inputs 10 times larger than the tests, and save the statistics:
+
+    {f} --bench --bench-scale 10 --bench-json bench.json
+
+Also write results for dashboards, as JSON lines and JUnit XML:
+
+    {f} --jsonl results.jsonl --junit results.xml
+
+Only run tests affected by changes since the last run, e.g. while editing tests:
+
+    {f} -i
+
+See which engines agree with each other on each input:
+
+    {f} --differential
+
+See which engines agree on the examples of a spec document, which have no expected output:
+
+    {f} --differential --source markdown-spec.html -s markdown-spec/
+
+See where the time of a run goes, e.g. process spawns, engines or normalization:
+
+    {f} --profile --no-cache -j 1
+
+Get a quick signal on all engines before merging, failing fast on previously failing tests:
+
+    {f} --sample 30 --failing-first --max-failures 3
+
+Split a run over 4 machines or processes, balanced by the times of the tests in a previous run, then combine the results:
+
+    {f} --shard 1/4 --timings previous.jsonl --jsonl shard-1.jsonl
+    ...
+    {f} --shard 4/4 --timings previous.jsonl --jsonl shard-4.jsonl
+    {f} --merge shard-*.jsonl
+
+Run the tests of an engine again whenever a test file changes, e.g. while editing tests:
+
+    {f} --watch multimarkdown
+
+Check how engines scale on generated documents of increasing size:
+
+    {f} --scaling
+
+Ignore cached outputs, e.g. after upgrading a library used by an engine:
+
+    {f} --refresh-cache
 """.format(f=sys.argv[0], config_file=md_testsuite.config_file),   # f contains command name.
         formatter_class=argparse.RawTextHelpFormatter,                 # Keep newlines.
     )
@@ -382,6 +2364,14 @@ Run only tests which contain a literal string in the name:
         default=False,
         help="Enable all engines for a single command."
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        default=1,
+        type=int,
+        help="""Number of engine commands to run in parallel, across all tests and engines.
+`0` uses the number of CPUs. Progress and summaries are still output in test order."""
+    )
     parser.add_argument(
         "-l",
         "--list-engines",
@@ -389,6 +2379,139 @@ Run only tests which contain a literal string in the name:
         default=False,
         help="List engines. If given, overrides all other options and nothing else is done."
     )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        action="store_true",
+        default=False,
+        help="""Convert all inputs of an engine with long lived processes instead of one process per test.
+Only affects engines which have a batch wrapper, e.g. `showdown-batch.js`. Others run one process per test,
+except Python engines such as `markdown2`, which always use long lived worker processes."""
+    )
+    parser.add_argument(
+        "--source",
+        action="append",
+        default=[],
+        metavar="PATH",
+        help="""Also take tests from PATH, which can be given multiple times. PATH is either:
+a test directory laid out like `{}`, a spec document such as `markdown-spec.html` whose examples are extracted,
+or a packed file: JSON lines or a tar archive, see `md_testsuite.PackedSource`.
+Tests are named after the basename of PATH, e.g. `markdown-spec/headings-1`.
+Examples without expected output are only used by `--differential` and `--bench`.""".format(md_testsuite.test_dir)
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        default=False,
+        help="""Do not read or write cached engine outputs.
+By default, outputs are cached under `cache_dir` of `{}`, keyed by engine version and input.""".format(
+        md_testsuite.config_file)
+    )
+    parser.add_argument(
+        "--refresh-cache",
+        action="store_true",
+        default=False,
+        help="Get all outputs from the engines again and overwrite the cached ones."
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        default=False,
+        help="""Record the time spent in each phase of each test, e.g. `spawn`, `engine`, `decode` or `normalize`,
+and print the totals by engine. Phases are also written to the records of `--jsonl`."""
+    )
+    parser.add_argument(
+        "--profile-dump",
+        default=None,
+        metavar="FILE",
+        help="""Implies `--profile`. Write cProfile statistics of the run to FILE, for `python -m pstats FILE`
+or flame graph tools, and the phase totals to `FILE.folded` as folded stacks.
+cProfile only sees the main thread, so use `-j 1` to include engine phases in FILE."""
+    )
+    parser.add_argument(
+        "--bench-normalize",
+        action="store_true",
+        default=False,
+        help="Time output normalization on multi-megabyte HTML instead of running tests."
+    )
+    parser.add_argument(
+        "--jsonl",
+        default=None,
+        metavar="FILE",
+        help="""Also write each test result to FILE as a JSON object per line, as soon as the test is done.
+Objects have the keys: `engine`, `suite`, `path`, `number`, `status` (`pass`, `fail`, `timeout` or `memory`),
+`time`, `peak_memory`, `engine_time`, `replayed` and `detail`.
+`engine_time` is the time the engine took to produce the output, unlike `time` also when it came from the cache,
+or `null` if unknown."""
+    )
+    parser.add_argument(
+        "--junit",
+        default=None,
+        metavar="FILE",
+        help="Also write each test result to FILE as JUnit XML, as soon as the test is done."
+    )
+    parser.add_argument(
+        "--peak-memory",
+        default=0,
+        type=int,
+        metavar="N",
+        help="After the summaries, print the N tests that used the most memory, with their engine."
+    )
+    parser.add_argument(
+        "--bench",
+        action="store_true",
+        default=False,
+        help="""Measure the conversion speed of engines instead of running tests.
+Prints startup overhead, p50 / p95 / p99 latencies of each test input, and throughput.
+Bypasses the output cache. Respects `engine`, `-s` and `-w`."""
+    )
+    parser.add_argument(
+        "--bench-repeat",
+        default=3,
+        type=int,
+        help="Number of times each input is converted by `--bench`."
+    )
+    parser.add_argument(
+        "--bench-scale",
+        default=1,
+        type=int,
+        help="Concatenate each input this many times for `--bench`, to measure larger documents."
+    )
+    parser.add_argument(
+        "--bench-json",
+        default=None,
+        help="Also write the `--bench` or `--scaling` statistics as JSON to this file."
+    )
+    parser.add_argument(
+        "--scaling",
+        action="store_true",
+        default=False,
+        help="""Time engines on generated documents of increasing size instead of running tests,
+and flag engines which scale superlinearly. Respects `engine` and `-w`."""
+    )
+    parser.add_argument(
+        "--differential",
+        action="store_true",
+        default=False,
+        help="""Render all inputs with all enabled and available engines instead of running tests,
+group engines whose outputs are the same after normalization, and print an agreement matrix.
+Respects `-s`, `-j` and `-w`."""
+    )
+    parser.add_argument(
+        "--build-index",
+        action="store_true",
+        default=False,
+        help="""Normalize all expected outputs and store them under `cache_dir`, then exit.
+The index is otherwise updated automatically for the expected outputs used by each run."""
+    )
+    parser.add_argument(
+        "-i",
+        "--incremental",
+        action="store_true",
+        default=False,
+        help="""Only run tests whose input, expected output, engine or normalization changed since their last run,
+and replay the stored result of the others, including their time. Incompatible with `--no-cache`."""
+    )
     parser.add_argument(
         "-n",
         "--number",
@@ -397,6 +2520,69 @@ Run only tests which contain a literal string in the name:
         help="""Only run the test with given number.
 The number of a test is affected by filtering options such as `-s`."""
     )
+    parser.add_argument(
+        "--sample",
+        default=0,
+        type=int,
+        metavar="N",
+        help="""Only run N of the tests selected by `-s` for each engine, spread evenly over test categories,
+which are the first words of test names such as `link` or `2-paragraphs`.
+The sample is the same for all engines and all runs with the same `--sample-seed`."""
+    )
+    parser.add_argument(
+        "--sample-seed",
+        default=0,
+        type=int,
+        help="Seed of the random choice of `--sample`."
+    )
+    parser.add_argument(
+        "--max-failures",
+        default=0,
+        type=int,
+        metavar="K",
+        help="""Stop running the tests of an engine after K of them failed. Tests are numbered in run order."""
+    )
+    parser.add_argument(
+        "--failing-first",
+        action="store_true",
+        default=False,
+        help="""Run the tests that did not pass on their last run first, e.g. with `--max-failures` to fail fast.
+Tests are numbered in run order. Incompatible with `--no-cache`."""
+    )
+    parser.add_argument(
+        "--shard",
+        default=None,
+        type=parse_shard,
+        metavar="i/N",
+        help="""Only run the i-th of N parts of the tests of each engine, with even total times.
+Shards must run the same engines and tests, e.g. with the same `-s` and `--sample`, and be balanced with the same
+timings: those of `--timings` if given, else of the last results of the tests stored under `cache_dir`.
+Shards do not store results. Tests keep their unsharded numbers, and `--merge` combines the `--jsonl` of all shards."""
+    )
+    parser.add_argument(
+        "--timings",
+        action="append",
+        default=[],
+        metavar="FILE",
+        help="""Balance `--shard` with the engine times of FILE, written by `--jsonl`. Can be given multiple times,
+e.g. with the `--jsonl` of all shards of a previous run."""
+    )
+    parser.add_argument(
+        "--merge",
+        nargs="+",
+        default=None,
+        metavar="FILE",
+        help="""Instead of running tests, combine the `--jsonl` FILEs of all `--shard`s of a run,
+and print their failures and summaries as `engine` does. Tests missing from or duplicated across FILEs are listed."""
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        default=False,
+        help="""After running the tests, watch the files of `{}` and run again the tests affected by each change,
+keeping workers and caches. Uses inotify if available, else polls the files. Interrupt to stop.""".format(
+        md_testsuite.test_dir)
+    )
     parser.add_argument(
         "-s",
         "--filter-string",
@@ -412,14 +2598,32 @@ If given, output expected / actual IO even if `engine` was not given."""
 Else, run all engines which are both enabled and available, and print only summarized output."""
     )
     args = parser.parse_args()
-
+    if args.watch and config['test_pack']:
+        parser.error("--watch needs the tests of `{}`, not `test_pack`".format(md_testsuite.test_dir))
+
+    for path in args.source:
+        md_testsuite.add_source(path, not args.no_cache)
+    index = md_testsuite.NormalizedOutputIndex(
+        os.path.join(config['cache_dir'], 'normalized-outputs.json.gz'),
+        normalize_output,
+        normalizer_version()
+    )
+    output_index = index
     disabled_by_conf = config['run_all_disable']
     if args.enable_all:
         enabled_engine_names = all_engine_names
     else:
         enabled_engine_names = filter(lambda e: not e in disabled_by_conf, all_engine_names)
-    enabled_and_available_engine_names = filter(lambda e: getattr(Engines, e).available(), enabled_engine_names)
-    enabled_and_not_available_engine_names = filter(lambda x: not x in enabled_and_available_engine_names, enabled_engine_names)
+    if args.list_engines:
+        available_engine_names = probe_engines(all_engine_names, not args.no_cache)
+        enabled_and_available_engine_names = filter(lambda e: e in available_engine_names, enabled_engine_names)
+    elif args.engine:
+        # Only probe to have the version of the engine, it is run even if not available.
+        probe_engines([args.engine], not args.no_cache)
+    elif args.bench or args.scaling or not (args.bench_normalize or args.build_index or args.merge):
+        enabled_and_available_engine_names = probe_engines(enabled_engine_names, not args.no_cache)
+        enabled_and_not_available_engine_names = filter(lambda x: not x in enabled_and_available_engine_names,
+                enabled_engine_names)
 
     if args.list_engines:
         print "All:                   {}\n" \
@@ -428,17 +2632,90 @@ Else, run all engines which are both enabled and available, and print only summa
               "Enabled and Available: {}".format(
               ", ".join(all_engine_names),
               ", ".join(enabled_engine_names),
-              ", ".join(filter(lambda e: getattr(Engines, e).available(), all_engine_names)),
+              ", ".join(available_engine_names),
               ", ".join(enabled_and_available_engine_names),
         )
-    else:
+    elif args.bench_normalize:
+        bench_normalize()
+    elif args.merge:
+        test_result, test_result_extension, problems = merge_results(args.merge, all_engine_names)
+        print format_error_ios_and_summaries(test_result, test_result_extension)
+        if args.peak_memory:
+            print "\nPeak memory:\n"
+            print format_peak_memories([test_result, test_result_extension], args.peak_memory)
+        if problems:
+            print "\n".join(problems)
+    elif args.bench or args.scaling:
         if args.engine:
+            bench_engine_names = [args.engine]
+        else:
+            bench_engine_names = enabled_and_available_engine_names
+        if args.workers:
+            for engine_name in bench_engine_names:
+                getattr(Engines, engine_name).start_workers()
+        if not bench_engine_names:
+            print "No engines are enabled. Install or enable some."
+            results = {}
+        elif args.bench:
+            results = bench_engines(bench_engine_names, args)
+        else:
+            results = scale_engines(bench_engine_names, args)
+        # Also the workers that Python engines start on first use.
+        for engine_name in bench_engine_names:
+            getattr(Engines, engine_name).stop_workers()
+        if args.bench_json:
+            with open(args.bench_json, 'w') as bench_file:
+                json.dump({'time': time.time(), 'workers': args.workers, 'scale': args.bench_scale,
+                        'engines': results}, bench_file, indent=2, sort_keys=True)
+    elif args.build_index:
+        index.build()
+        index.save()
+        print "Normalized outputs: {}".format(len(index.entries))
+    else:
+        if args.jobs == 0:
+            args.jobs = multiprocessing.cpu_count()
+        if args.jobs > 1:
+            pool = ThreadPool(args.jobs)
+        else:
+            pool = None
+        if args.workers:
+            for engine_name in all_engine_names:
+                getattr(Engines, engine_name).start_workers()
+        if args.jsonl:
+            result_writers.append(JSONLinesWriter(args.jsonl))
+        if args.junit:
+            result_writers.append(JUnitWriter(args.junit))
+        if not args.no_cache:
+            output_cache = md_testsuite.OutputCache(
+                os.path.join(config['cache_dir'], 'outputs.sqlite'),
+                config['cache_max_size'],
+                refresh=args.refresh_cache
+            )
+            result_store = md_testsuite.ResultStore(os.path.join(config['cache_dir'], 'results.sqlite'))
+        if args.timings:
+            shard_timings = load_timings(args.timings)
+        if config['normalize_memo_max_size']:
+            normalize_memo = NormalizeMemo(config['normalize_memo_max_size'])
+        if args.profile or args.profile_dump:
+            profiler = Profiler()
+        if args.profile_dump:
+            c_profile = cProfile.Profile()
+            c_profile.enable()
+        if args.differential:
+            differential(enabled_and_available_engine_names, args, pool)
+            test_results = []
+        elif args.engine:
             engine_name = args.engine
-            test_result = run_tests(md_testsuite.io_iterator(), engine_name, len(engine_name), args)
+            scheduled_tests = schedule_tests(md_testsuite.test_cases(), engine_name, args, pool)
+            scheduled_tests_extension = schedule_tests(md_testsuite.test_cases_engine(engine_name),
+                    engine_name, args, pool, 'extensions')
+            test_result = run_tests(scheduled_tests, engine_name, len(engine_name), args)
             print "\nExtensions:\n"
-            test_result_extension = run_tests(md_testsuite.io_iterator_engine(engine_name),
-                    engine_name, len(engine_name), args)
+            test_result_extension = run_tests(scheduled_tests_extension, engine_name, len(engine_name), args)
             print format_error_ios_and_summaries(test_result, test_result_extension)
+            test_results = [test_result, test_result_extension]
+            if args.watch:
+                watch_tests([engine_name], args, pool)
         else:
             if disabled_by_conf:
                 print "Disabled engines:              {}".format(", ".join(disabled_by_conf))
@@ -450,14 +2727,51 @@ Else, run all engines which are both enabled and available, and print only summa
                 print
             if enabled_and_available_engine_names:
                 l = len(max(enabled_and_available_engine_names, key=len))
+                # Schedule everything upfront so that a pool can work ahead of the progress output.
+                scheduled_tests = [schedule_tests(md_testsuite.test_cases(), engine_name, args, pool)
+                        for engine_name in enabled_and_available_engine_names]
+                scheduled_tests_extension = [schedule_tests(md_testsuite.test_cases_engine(engine_name),
+                        engine_name, args, pool, 'extensions') for engine_name in enabled_and_available_engine_names]
                 test_result = TestResult()
-                for engine_name in enabled_and_available_engine_names:
-                    test_result += run_tests(md_testsuite.io_iterator(), engine_name, l, args)
+                for engine_name, scheduled in zip(enabled_and_available_engine_names, scheduled_tests):
+                    test_result += run_tests(scheduled, engine_name, l, args)
                 print "\nExtensions:\n"
                 test_result_extension = TestResult()
-                for engine_name in enabled_and_available_engine_names:
-                    test_result_extension += run_tests(md_testsuite.io_iterator_engine(engine_name), engine_name, l, args)
+                for engine_name, scheduled in zip(enabled_and_available_engine_names, scheduled_tests_extension):
+                    test_result_extension += run_tests(scheduled, engine_name, l, args)
                 if args.filter_string:
                     print format_error_ios_and_summaries(test_result, test_result_extension)
+                test_results = [test_result, test_result_extension]
+                if args.watch:
+                    watch_tests(enabled_and_available_engine_names, args, pool)
             else:
                 print "No engines are enabled. Install or enable some."
+                test_results = []
+        if args.peak_memory and test_results:
+            print "\nPeak memory:\n"
+            print format_peak_memories(test_results, args.peak_memory)
+        if args.profile_dump:
+            c_profile.disable()
+            c_profile.dump_stats(args.profile_dump)
+            profiler.write_folded(args.profile_dump + '.folded')
+        if profiler is not None and profiler.tests:
+            print "\nProfile:\n"
+            print profiler.format_summary()
+        if pool is not None:
+            pool.close()
+            pool.join()
+        index.save()
+        if output_cache is not None:
+            if output_cache.hits or output_cache.misses:
+                print "\nCache: {} hits {} misses".format(output_cache.hits, output_cache.misses)
+            output_cache.close()
+        if normalize_memo is not None and normalize_memo.hits:
+            print "\nNormalize memo: {} hits {} misses ({:.1%} hit rate)".format(
+                    normalize_memo.hits, normalize_memo.misses, normalize_memo.hit_rate())
+        if result_store is not None:
+            result_store.close()
+        for writer in result_writers:
+            writer.close()
+        # Also the workers that Python engines start on first use.
+        for engine_name in all_engine_names:
+            getattr(Engines, engine_name).stop_workers()
@@ -0,0 +1,18 @@
+#!/usr/bin/env node
+// Wrapper to run showdown on many inputs from a single process.
+// Inputs are read on stdin and outputs written to stdout, each terminated by a NUL character.
+var Showdown = require('showdown')
+var converter = new Showdown.converter()
+process.stdin.setEncoding('utf8')
+var input = ''
+process.stdin.on('readable', function() {
+  var chunk = process.stdin.read()
+  if (chunk !== null ) {
+    input += chunk
+    var end
+    while ((end = input.indexOf('\0')) !== -1) {
+      process.stdout.write(converter.makeHtml(input.slice(0, end)) + '\0')
+      input = input.slice(end + 1)
+    }
+  }
+})